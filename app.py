@@ -6,6 +6,7 @@ import yaml
 from utils.file_operations import list_folders, urlify
 from huggingface_hub import snapshot_download
 from wrapper import generator_wrapper
+from utils.knowledge_builder import start_background_compaction
 
 # future:
 #   generation.log sometimes disappears (ignore this)
@@ -76,6 +77,8 @@ if HF_TOKEN is not None and REPO_ID is not None:
 #######################################################################################################################
 ALL_TEMPLATES = list_folders("latex_templates")
 ALL_DATABASES = ["(None)"] + list_folders("knowledge_databases")
+# compact the knowledge databases with many deleted chunks while the app is running
+start_background_compaction()
 
 #######################################################################################################################
 # Gradio UI
@@ -170,7 +173,8 @@ def wrapped_generator(
         tldr=True, max_kw_refs=10, refs=None, max_tokens_ref=2048,  # references
         knowledge_database=None, max_tokens_kd=2048, query_counts=10,  # domain knowledge
         paper_template="ICLR2022", selected_sections=None, model="gpt-4", prompts_mode=False,  # outputs parameters
-        cache_mode=IS_CACHE_AVAILABLE  # handle cache mode
+        cache_mode=IS_CACHE_AVAILABLE,  # handle cache mode
+        progress=gr.Progress()  # forward the streamed tokens
 ):
     file_name_upload = urlify(paper_title) + "_" + uuid.uuid1().hex + ".zip"
 
@@ -190,6 +194,13 @@ def wrapped_generator(
     config["output"]["model"] = model
     config["output"]["template"] = paper_template
     config["output"]["prompts_mode"] = prompts_mode
+    config["output"]["stream"] = True
+
+    tokens_count = {}
+
+    def forward_progress(section, token):
+        tokens_count[section] = tokens_count.get(section, 0) + 1
+        progress(None, desc=f"正在生成 {section}: {tokens_count[section]} tokens")
 
     if openai_api_key is not None:
         openai.api_key = openai_api_key
@@ -198,7 +209,7 @@ def wrapped_generator(
         except Exception as e:
             raise gr.Error(f"Key错误. Error: {e}")
     try:
-        output = generator_wrapper(config)
+        output = generator_wrapper(config, progress_callback=forward_progress)
         if cache_mode:
             from utils.storage import upload_file
             upload_file(output, target_name=file_name_upload)
@@ -1,46 +1,76 @@
+import contextlib
+import contextvars
 import json
 import os.path
 import logging
 import time
 from utils import References, Knowledge
+from utils.knowledge import KNOWLEDGE_DATABASES, read_db_meta
 from utils.file_operations import copy_templates
 from utils.tex_processing import create_copies
-from prompts.draft import generate_paper_prompts
+from utils.scheduler import run_dependency_graph
+from utils.usage import UsageMeter
+from utils.cache import StageStore, make_key
+from utils.tracing import Tracer, activate, current_tracer, span, traced, TRACE_ENABLED
+from prompts.draft import generate_paper_prompts, get_prompt_variables
 from prompts import SYSTEM, SECTION_GENERATION_SYSTEM
-from langchain.vectorstores import FAISS
 from utils.gpt_interaction import GPTModel
-from models import EMBEDDINGS
 
-TOTAL_TOKENS = 0
-TOTAL_PROMPTS_TOKENS = 0
-TOTAL_COMPLETION_TOKENS = 0
+# the `generation.log` handler of the current run; it is carried into the thread pools of the run with its context
+_RUN_LOG = contextvars.ContextVar("run_log", default=None)
 
 
-def log_usage(usage, generating_target, print_out=True):
-    global TOTAL_TOKENS
-    global TOTAL_PROMPTS_TOKENS
-    global TOTAL_COMPLETION_TOKENS
+class _RunLog(logging.Filter):
+    # only pass the log lines emitted by the run that owns this filter
+    def __init__(self):
+        super().__init__()
+        self.handler = None
 
-    prompts_tokens = usage['prompt_tokens']
-    completion_tokens = usage['completion_tokens']
-    total_tokens = usage['total_tokens']
+    def filter(self, record):
+        return _RUN_LOG.get() is self
 
-    TOTAL_TOKENS += total_tokens
-    TOTAL_PROMPTS_TOKENS += prompts_tokens
-    TOTAL_COMPLETION_TOKENS += completion_tokens
+    def open(self, path):
+        if self.handler is not None:
+            return
+        root = logging.getLogger()
+        if root.getEffectiveLevel() > logging.INFO:
+            root.setLevel(logging.INFO)
+        self.handler = logging.FileHandler(path, encoding="utf-8")
+        self.handler.setFormatter(logging.Formatter(logging.BASIC_FORMAT))
+        self.handler.addFilter(self)
+        root.addHandler(self.handler)
 
-    message = f">>USAGE>> For generating {generating_target}, {total_tokens} tokens have been used " \
-              f"({prompts_tokens} for prompts; {completion_tokens} for completion). " \
-              f"{TOTAL_TOKENS} tokens have been used in total."
-    if print_out:
-        print(message)
-    logging.info(message)
+    def close(self):
+        if self.handler is not None:
+            logging.getLogger().removeHandler(self.handler)
+            self.handler.close()
+            self.handler = None
+
+
+def _knowledge_database_version(name):
+    # the "version" of `db_meta.json`, increased by every append, delete and compaction (None if there is no database)
+    try:
+        return read_db_meta(os.path.join(KNOWLEDGE_DATABASES.root, str(name))).get("version", 0)
+    except (OSError, ValueError):
+        return None
+
+
+@contextlib.contextmanager
+def _run_log():
+    # many runs can share one process (see `batch_generator_wrapper`); each one writes its own `generation.log`
+    run_log = _RunLog()
+    token = _RUN_LOG.set(run_log)
+    try:
+        yield run_log
+    finally:
+        run_log.close()
+        _RUN_LOG.reset(token)
 
 
 def _generation_setup(title, description="", template="ICLR2022",
                       tldr=False, max_kw_refs=10, refs=None, max_tokens_ref=2048,  # generating references
                       knowledge_database=None, max_tokens_kd=2048, query_counts=10,  # querying from knowledge database
-                      debug=True):
+                      debug=True, max_workers=4, meter=None, resume_from=None):
     """
     This function handles the setup process for paper generation. It mainly does the following:
         1. Copies the provided template to the outputs folder and creates the log file `generation.log`.
@@ -50,6 +80,9 @@ def _generation_setup(title, description="", template="ICLR2022",
         5. Generates necessary media based on the title and contributions.
         6. Returns a paper object containing the collected information,
             the destination folder path, and a list of all collected paper IDs.
+    Steps 2-5 are run as a stage graph: stages which do not depend on each other (e.g. searching references and
+    generating the domain knowledge) run concurrently. The wall time of each stage is reported. The output of each
+    stage is saved in `<destination_folder>/stages` for resuming the run later.
 
     Parameters:
         title (str): The title of the paper.
@@ -66,6 +99,11 @@ def _generation_setup(title, description="", template="ICLR2022",
         query_counts (int, optional): The number of queries to perform against the knowledge database. Defaults to 10.
         debug (bool, optional): A flag that if set to True, will raise exceptions,
             otherwise, it will print the error message and continue. Defaults to True.
+        max_workers (int, optional): The maximum number of stages running at the same time. Defaults to 4.
+        meter (UsageMeter, optional): The usage meter of this run. A new one is created if not given. The usage is
+            saved to `usage.json` in the destination folder.
+        resume_from (str, optional): The folder of a previous run. If given, this run writes into that folder and
+            only computes the stages whose inputs have changed. Defaults to None.
 
     Returns:
         tuple: A tuple containing the following elements:
@@ -74,109 +112,182 @@ def _generation_setup(title, description="", template="ICLR2022",
             - all_paper_ids (list): A list of all paper IDs collected for the references.
     """
     llm = GPTModel(model="gpt-3.5-turbo")
+    if meter is None:
+        meter = UsageMeter()
 
     # Create a copy in the outputs folder.
-    bibtex_path, destination_folder = copy_templates(template, title)
-    logging.basicConfig(level=logging.INFO, filename=os.path.join(destination_folder, "generation.log"))
+    bibtex_path, destination_folder = copy_templates(template, title, destination_folder=resume_from)
+    if _RUN_LOG.get() is not None:
+        _RUN_LOG.get().open(os.path.join(destination_folder, "generation.log"))
+
+    # Each stage saves its output in `outputs`; a stage only starts after all stages it depends on are finished.
+    # The outputs are also saved in the run folder, keyed by the hash of the stage's inputs (see `StageStore`).
+    outputs = {}
+    store = StageStore(os.path.join(destination_folder, "stages"))
+
+    def _memoized(stage, compute, inputs):
+        def _run():
+            # a stage loaded from the saved outputs uses no tokens, so the budget is only checked before computing
+            outputs[stage] = store.memoize(stage, inputs(), compute, before_compute=meter.check_budget)
+        return _run
 
     ###################################################################################################################
     # Generate contributions
     ###################################################################################################################
-    if description:
-        contributions = description
-    else:
+    def _contributions():
+        if description:
+            contributions = description
+        else:
+            try:
+                contributions, usage = llm(systems=SYSTEM["contributions"], prompts=title, return_json=True)
+                contributions = [f"Contribution {idx}: {contributions[contribution]['statement']}\n" \
+                                 f"Novelty of Contribution {idx}: {contributions[contribution]['reason']}\n"
+                                 for idx, contribution in enumerate(contributions)]
+                contributions = "".join(contributions)
+                meter.log_usage(usage, "contributions")
+            except RuntimeError:
+                if debug:
+                    raise RuntimeError("Failed to generate contributions.")
+                else:
+                    print("Failed to generate contributions. Use empty contributions.")
+                    contributions = ""
+        print("Contributions:\n{}".format(contributions))
+        return contributions
+
+    ###################################################################################################################
+    # Generate references
+    ###################################################################################################################
+    def _keywords():
         try:
-            contributions, usage = llm(systems=SYSTEM["contributions"], prompts=title, return_json=True)
-            contributions = [f"Contribution {idx}: {contributions[contribution]['statement']}\n" \
-                             f"Novelty of Contribution {idx}: {contributions[contribution]['reason']}\n"
-                             for idx, contribution in enumerate(contributions)]
-            contributions = "".join(contributions)
-            log_usage(usage, "contributions")
+            keywords, usage = llm(systems=SYSTEM["keywords"], prompts=title, return_json=True)
+            meter.log_usage(usage, "keywords")
+            keywords = {keyword: max_kw_refs for keyword in keywords}
         except RuntimeError:
             if debug:
-                raise RuntimeError("Failed to generate contributions.")
+                raise RuntimeError("Failed to generate keywords.")
             else:
-                print("Failed to generate contributions. Use empty contributions.")
-                contributions = ""
-    print("Contributions:\n{}".format(contributions))
+                print("Failed to generate keywords. Use default keywords.")
+                keywords = {"machine learning": max_kw_refs, "artificial intelligence": max_kw_refs}  # DEFAULT KEYWORDS
+        print("Keywords: \n", keywords)
+        return keywords
+
+    def _papers():
+        # todo: in some rare situations, collected papers will be an empty list. handle this issue
+        ref = References(title, load_papers=refs)
+        ref.collect_papers(outputs["keywords"], tldr=tldr)
+        return ref.dump_papers()
+
+    def _references():
+        ref = References(title)
+        ref.load_papers(outputs["papers"])
+        prompts = ref.to_prompts(max_tokens=max_tokens_ref)
+        all_paper_ids = ref.to_bibtex(bibtex_path)
+        with open(bibtex_path, "r", encoding="utf-8") as f:
+            bibtex = f.read()
+        return {"prompts": prompts, "all_paper_ids": all_paper_ids, "bibtex": bibtex}
+
     ###################################################################################################################
-    # Generate references
+    # Generate domain knowledge
     ###################################################################################################################
-    try:
-        keywords, usage = llm(systems=SYSTEM["keywords"], prompts=title, return_json=True)
-        log_usage(usage, "keywords")
-        keywords = {keyword: max_kw_refs for keyword in keywords}
-    except RuntimeError:
-        if debug:
-            raise RuntimeError("Failed to generate keywords.")
+    def _preliminaries():
+        prompts = f"Title: {title}\n Contributions: {outputs['contributions']}"
+        preliminaries, usage = llm(systems=SYSTEM["preliminaries"], prompts=prompts)
+        meter.log_usage(usage, "preliminaries")
+        return preliminaries
+
+    def _domain_knowledge():
+        # check if the database exists or not
+        db_path = f"knowledge_databases/{knowledge_database}"
+        if os.path.isdir(db_path):
+            try:
+                # the database is loaded once per process and shared by all runs
+                database = KNOWLEDGE_DATABASES.get_entry(knowledge_database)
+                knowledge = Knowledge(db=database["db"], embeddings=database["embeddings"],
+                                      deleted=database["deleted"])
+                knowledge.collect_knowledge(outputs["preliminaries"], max_query=query_counts)
+                domain_knowledge = knowledge.to_prompts(max_tokens_kd)
+            except Exception as e:
+                if debug:
+                    raise RuntimeError(f"Failed to query from FAISS. Error {e}.")
+                else:
+                    print(f"Failed to query from FAISS. Error {e}. Use empty domain knowledge instead.")
+                    domain_knowledge = ""
         else:
-            print("Failed to generate keywords. Use default keywords.")
-            keywords = {"machine learning": max_kw_refs, "artificial intelligence": max_kw_refs}  # DEFAULT KEYWORDS
-
-    print("Keywords: \n", keywords)
-    # todo: in some rare situations, collected papers will be an empty list. handle this issue
-    ref = References(title, load_papers=refs)
-    ref.collect_papers(keywords, tldr=tldr)
-    references = ref.to_prompts(max_tokens=max_tokens_ref)
-    all_paper_ids = ref.to_bibtex(bibtex_path)
+            print("Selected database doesn't exist or no database is selected.")
+            domain_knowledge = ""
+        return domain_knowledge
+
     ###################################################################################################################
-    # Generate domain knowledge
+    # Generate necessary media
     ###################################################################################################################
-    prompts = f"Title: {title}\n Contributions: {contributions}"
-    preliminaries_kw, _ = llm(systems=SYSTEM["preliminaries"], prompts=prompts)
-    # check if the database exists or not
-    db_path = f"knowledge_databases/{knowledge_database}"
-    db_config_path = os.path.join(db_path, "db_meta.json")
-    db_index_path = os.path.join(db_path, "faiss_index")
-    if os.path.isdir(db_path):
+    def _components():
+        prompts = f"Title: {title}\n Contributions: {outputs['contributions']}"
         try:
-            # load configuration file
-            with open(db_config_path, "r", encoding="utf-8") as f:
-                db_config = json.load(f)
-            model_name = db_config["embedding_model"]
-            embeddings = EMBEDDINGS[model_name]
-            db = FAISS.load_local(db_index_path, embeddings)
-            knowledge = Knowledge(db=db)
-            knowledge.collect_knowledge(preliminaries_kw, max_query=query_counts)
-            domain_knowledge = knowledge.to_prompts(max_tokens_kd)
-        except Exception as e:
+            components, usage = llm(systems=SYSTEM["components"], prompts=prompts, return_json=True)
+            meter.log_usage(usage, "media")
+        except RuntimeError:
             if debug:
-                raise RuntimeError(f"Failed to query from FAISS. Error {e}.")
+                raise RuntimeError("Failed to generate media.")
             else:
-                print(f"Failed to query from FAISS. Error {e}. Use empty domain knowledge instead.")
-                domain_knowledge = ""
-    else:
-        print("Selected database doesn't exist or no database is selected.")
-        domain_knowledge = ""
+                print("Failed to generate media. Use default media.")
+                components = {}
+        return components
 
     ###################################################################################################################
-    # Generate necessary media
+    # Run all stages
     ###################################################################################################################
-    prompts = f"Title: {title}\n Contributions: {contributions}"
-    try:
-        components, usage = llm(systems=SYSTEM["components"], prompts=prompts, return_json=True)
-        log_usage(usage, "media")
-    except RuntimeError:
-        if debug:
-            raise RuntimeError("Failed to generate media.")
-        else:
-            print("Failed to generate media. Use default media.")
-            components = {}
+    # the inputs of each stage: a stage is computed again only if its inputs have changed
+    stages = {
+        "contributions": _memoized("contributions", _contributions,
+                                   lambda: {"title": title, "description": description}),
+        "keywords": _memoized("keywords", _keywords, lambda: {"title": title, "max_kw_refs": max_kw_refs}),
+        "papers": _memoized("papers", _papers,
+                            lambda: {"title": title, "keywords": outputs["keywords"], "tldr": tldr, "refs": refs}),
+        "references": _memoized("references", _references,
+                                # the digest of the papers (with their embeddings) instead of the papers themselves
+                                lambda: {"papers": make_key(outputs["papers"]), "max_tokens_ref": max_tokens_ref}),
+        "preliminaries": _memoized("preliminaries", _preliminaries,
+                                   lambda: {"title": title, "contributions": outputs["contributions"]}),
+        "domain_knowledge": _memoized("domain_knowledge", _domain_knowledge,
+                                      lambda: {"preliminaries": outputs["preliminaries"],
+                                               "knowledge_database": knowledge_database,
+                                               "version": _knowledge_database_version(knowledge_database),
+                                               "max_tokens_kd": max_tokens_kd, "query_counts": query_counts}),
+        "components": _memoized("components", _components,
+                                lambda: {"title": title, "contributions": outputs["contributions"]}),
+    }
+    dependencies = {"papers": ["keywords"],
+                    "references": ["papers"],
+                    "preliminaries": ["contributions"],
+                    "domain_knowledge": ["preliminaries"],
+                    "components": ["contributions"]}
+    stages = {stage: traced(f"stage.{stage}")(job) for stage, job in stages.items()}
+    timings = {}
+    start_time = time.perf_counter()
+    with span("stage.setup"):
+        run_dependency_graph(stages, dependencies, max_workers=max_workers, timings=timings)
+    for stage in stages:
+        meter.log_time(stage, timings[stage])
+    meter.log_time("setup", time.perf_counter() - start_time)
+    meter.save(os.path.join(destination_folder, "usage.json"))
+    # `ref.bib` is written again in case the references are loaded from the saved outputs
+    with open(bibtex_path, "w", encoding="utf-8") as f:
+        f.write(outputs["references"]["bibtex"])
 
     print(f"The paper information has been initialized. References are saved to {bibtex_path}.")
 
     paper = {}
     paper_body = {}
     paper["title"] = title
-    paper["description"] = contributions
-    paper["references"] = references
+    paper["description"] = outputs["contributions"]
+    paper["references"] = outputs["references"]["prompts"]
     paper["body"] = paper_body
     paper["bibtex"] = bibtex_path
-    paper["domain_knowledge"] = domain_knowledge
-    paper["components"] = components
+    paper["domain_knowledge"] = outputs["domain_knowledge"]
+    paper["components"] = outputs["components"]
 
     # print(json.dumps(paper, indent=4))
-    return paper, destination_folder, all_paper_ids
+    return paper, destination_folder, outputs["references"]["all_paper_ids"]
     # todo: use `all_paper_ids` to check if all citations are in this list
 
 
@@ -184,13 +295,18 @@ def generate_draft(title, description="",  # main input
                    tldr=True, max_kw_refs=10, refs=None, max_tokens_ref=2048,  # references
                    knowledge_database=None, max_tokens_kd=2048, query_counts=10,  # domain knowledge
                    sections=None, model="gpt-4", template="ICLR2022", prompts_mode=False,  # outputs parameters
+                   max_workers=4,  # concurrency
+                   stream=False, progress_callback=None,  # streaming
+                   meter=None, trace=TRACE_ENABLED,  # usage and tracing
+                   resume_from=None,  # resume a previous run
                    ):
     """
     This function generates a draft paper using the provided information. The process is divided into three steps:
 
     1. Pre-processing: Initializes the setup for paper generation and arranges the sections in the desired order.
     2. Processing: Generates each section of the paper using the specified language model and writes the generated
-       contents into a .tex file.
+       contents into a .tex file. Sections are scheduled as a dependency graph: a section whose prompt reads the
+       existing body waits for the sections before it; other sections are generated concurrently.
     3. Post-processing: Saves the prompts used for each section into a .json file and returns the path to the
        destination folder containing all the generated files.
 
@@ -215,6 +331,21 @@ def generate_draft(title, description="",  # main input
         template (str, optional): The template to be used for paper generation. Defaults to "ICLR2022".
         prompts_mode (bool, optional): A flag indicating whether to generate only the prompts for each section
                                        without generating the section contents. Defaults to False.
+        max_workers (int, optional): The maximum number of sections generated at the same time. Defaults to 4.
+        stream (bool, optional): A flag indicating whether to stream the response of each section. The tokens are
+                                 appended to the .tex file as they arrive. Defaults to False.
+        progress_callback (callable, optional): Called as `progress_callback(section, token)` for each streamed token.
+                                                If it returns False, the generation of this section is aborted and
+                                                the partial section is kept. Defaults to None.
+        meter (UsageMeter, optional): The usage meter of this run. A new one is created if not given. The usage is
+                                      saved to `usage.json` in the destination folder.
+        trace (bool, optional): A flag indicating whether to trace the stages of this run and save the timeline to
+                                `trace.json` in the destination folder. Ignored if a tracer is already active (e.g.
+                                created by `generator_wrapper`). Defaults to the environment variable AUTO_DRAFT_TRACE.
+        resume_from (str, optional): The destination folder of a previous run. The outputs of each stage and section
+                                     are saved in `<destination folder>/stages`, keyed by the hash of their inputs; if
+                                     given, only the stages and sections whose inputs have changed are generated again.
+                                     Defaults to None.
 
     Returns:
     str: The path to the destination folder containing the generated files.
@@ -229,6 +360,25 @@ def generate_draft(title, description="",  # main input
         return [section for section in ordered_sections if section in sections]
 
     # pre-processing `sections` parameter;
+    owns_tracer = trace and current_tracer() is None
+    if owns_tracer or _RUN_LOG.get() is None:
+        # this run owns the tracer (save the timeline into the destination folder when finished) and/or its log
+        tracer = Tracer() if owns_tracer else current_tracer()
+        log = _run_log() if _RUN_LOG.get() is None else contextlib.nullcontext()
+        with activate(tracer), log:
+            destination_folder = generate_draft(title, description, tldr=tldr, max_kw_refs=max_kw_refs, refs=refs,
+                                                max_tokens_ref=max_tokens_ref, knowledge_database=knowledge_database,
+                                                max_tokens_kd=max_tokens_kd, query_counts=query_counts,
+                                                sections=sections, model=model, template=template,
+                                                prompts_mode=prompts_mode, max_workers=max_workers, stream=stream,
+                                                progress_callback=progress_callback, meter=meter, trace=False,
+                                                resume_from=resume_from)
+        if owns_tracer:
+            tracer.save(os.path.join(destination_folder, "trace.json"))
+        return destination_folder
+
+    if meter is None:
+        meter = UsageMeter()
     print("================START================")
     print(f"Generating the paper '{title}'.")
     print("================PRE-PROCESSING================")
@@ -241,35 +391,87 @@ def generate_draft(title, description="",  # main input
     paper, destination_folder, _ = _generation_setup(title, description, template, tldr, max_kw_refs, refs,
                                                      max_tokens_ref=max_tokens_ref, max_tokens_kd=max_tokens_kd,
                                                      query_counts=query_counts,
-                                                     knowledge_database=knowledge_database)
+                                                     knowledge_database=knowledge_database,
+                                                     max_workers=max_workers, meter=meter,
+                                                     resume_from=resume_from)
 
     # main components
     prompts_dict = {}
     print(f"================PROCESSING================")
-    for section in sections:
-        prompts = generate_paper_prompts(paper, section)
+    llm = GPTModel(model=model)
+    store = StageStore(os.path.join(destination_folder, "stages"))
+
+    def _section_body(section):
+        # the sections written before `section` (in the desired order); same as what the sequential loop would see
+        previous = sections[:sections.index(section)]
+        return {s: paper["body"][s] for s in previous if s in paper["body"]}
+
+    def _generate_section(section):
+        prompts = generate_paper_prompts(dict(paper, body=_section_body(section)), section)
         prompts_dict[section] = prompts
         if prompts_mode:
-            continue
+            return
+        systems = SECTION_GENERATION_SYSTEM.format(research_field="machine learning")
+        tex_file = os.path.join(destination_folder, f"{section}.tex")
+        inputs = {"model": model, "systems": systems, "prompts": prompts}
+        found, output = store.get(section, inputs)
+        if found:
+            print(f"{section} part is loaded from the saved outputs.")
+            with open(tex_file, "w", encoding="utf-8") as f:
+                f.write(output)
+            paper["body"][section] = output
+            return
+        meter.check_budget()
         print(f"Generate {section} part...")
-        prompts = generate_paper_prompts(paper, section)
-        chatgpt = GPTModel(model=model)
-        output, usage = chatgpt(systems=SECTION_GENERATION_SYSTEM.format(research_field="machine learning"),
-                                prompts=prompts)
+        aborted = []
+        if stream:
+            # append tokens to the .tex file as they arrive
+            with open(tex_file, "w", encoding="utf-8") as f:
+                def _on_token(token):
+                    f.write(token)
+                    f.flush()
+                    if progress_callback is not None and progress_callback(section, token) is False:
+                        aborted.append(True)
+                        return False
+                output, usage = llm.stream(systems=systems, prompts=prompts, callback=_on_token)
+        else:
+            output, usage = llm(systems=systems, prompts=prompts)
+            with open(tex_file, "w", encoding="utf-8") as f:
+                f.write(output)
         paper["body"][section] = output
-        tex_file = os.path.join(destination_folder, f"{section}.tex")
-        with open(tex_file, "w", encoding="utf-8") as f:
-            f.write(output)
-        time.sleep(5)
+        if not aborted:
+            store.set(section, inputs, output)
         print(f"{section} part has been generated. ")
-        log_usage(usage, section)
+        meter.log_usage(usage, section)
+
+    # sections whose prompts read the existing `body` wait for all sections before them; others run concurrently
+    dependencies = {}
+    for idx, section in enumerate(sections):
+        if "body" in get_prompt_variables(section):
+            dependencies[section] = sections[:idx]
+    jobs = {section: traced(f"section.{section}")(lambda s=section: _generate_section(s)) for section in sections}
+    timings = {}
+    try:
+        run_dependency_graph(jobs, dependencies, max_workers=max_workers, timings=timings)
+    except Exception:
+        print(f"Failed to generate the paper. The finished stages and sections are saved in {destination_folder}; "
+              f"pass `resume_from='{destination_folder}'` to continue.")
+        raise
+    if not prompts_mode:
+        for section in sections:
+            meter.log_time(section, timings[section])
+    # keep the same order as the sequential generation
+    prompts_dict = {section: prompts_dict[section] for section in sections}
+    paper["body"] = {section: paper["body"][section] for section in sections if section in paper["body"]}
 
     # post-processing
     print("================POST-PROCESSING================")
-    create_copies(destination_folder)
+    with span("stage.post_processing"):
+        create_copies(destination_folder)
     filename = "prompts.json"
     with open(os.path.join(destination_folder, filename), "w") as f:
         json.dump(prompts_dict, f)
+    meter.save(os.path.join(destination_folder, "usage.json"))
     print("\nMission completed.\n")
     return destination_folder
 
@@ -0,0 +1,38 @@
+#!/usr/bin/env python
+# Compare FAISS index types on the vectors of a knowledge database with a Flat index
+# (see `benchmark_index_types` in `utils/knowledge_builder.py`).
+#
+#   python benchmark-knowledge-database.py my_database --k 10
+#
+# For each index type, print recall@k against the Flat index, the query latency, the index size and the build time.
+# Use the results to choose "index" in `db_meta.json` (or `--index-type` of `build-knowledge-database.py`).
+
+import argparse
+import json
+
+from utils.knowledge_builder import benchmark_index_types
+
+DEFAULT_INDEX_CONFIGS = [
+    {"type": "IVF-Flat", "nlist": 256, "nprobe": 8},
+    {"type": "IVF-Flat", "nlist": 256, "nprobe": 32},
+    {"type": "HNSW", "M": 32, "efConstruction": 200, "efSearch": 64},
+    {"type": "IVF-PQ", "nlist": 256, "m": 16, "nbits": 8, "nprobe": 32},
+]
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark FAISS index types on a knowledge database.")
+    parser.add_argument("name", help="the name of a database with a Flat index")
+    parser.add_argument("--output-folder", default="knowledge_databases")
+    parser.add_argument("--k", type=int, default=10)
+    parser.add_argument("--queries", type=int, default=1000, help="the number of queries")
+    parser.add_argument("--index-configs", default=None,
+                        help='JSON list, e.g. \'[{"type": "HNSW", "M": 16}]\'; defaults to DEFAULT_INDEX_CONFIGS')
+    args = parser.parse_args()
+
+    index_configs = DEFAULT_INDEX_CONFIGS if args.index_configs is None else json.loads(args.index_configs)
+    results = benchmark_index_types(args.name, index_configs, k=args.k, num_queries=args.queries,
+                                    output_folder=args.output_folder)
+    print(f"{'index':<70} {'recall@' + str(args.k):>10} {'latency (ms)':>14} {'size (MB)':>10} {'build (s)':>10}")
+    for result in results:
+        print(f"{json.dumps(result['index']):<70} {result[f'recall@{args.k}']:>10.4f} {result['latency_ms']:>14.4f} "
+              f"{result['size_mb']:>10.2f} {result['build_seconds']:>10.2f}")
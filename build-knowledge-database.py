@@ -0,0 +1,34 @@
+#!/usr/bin/env python
+# Build a knowledge database from a folder of PDF/text files (see `utils/knowledge_builder.py`).
+#
+#   python build-knowledge-database.py path/to/documents my_database
+#
+# The database is saved to `knowledge_databases/my_database` and can be selected by `knowledge_database` in the
+# configuration (or in the UI).
+
+import argparse
+import json
+
+from utils.knowledge_builder import INDEX_TYPES, build_knowledge_database
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Build a knowledge database from a folder of PDF/text files.")
+    parser.add_argument("input_folder", help="the folder of .pdf, .txt, .md and .tex files")
+    parser.add_argument("name", help="the name of the database")
+    parser.add_argument("--output-folder", default="knowledge_databases")
+    parser.add_argument("--embedding-model", default="all-MiniLM-L6-v2",
+                        help="all-MiniLM-L6-v2 or text-embedding-ada-002 (needs OPENAI_API_KEY)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="the maximum number of tokens of one chunk")
+    parser.add_argument("--chunk-overlap", type=int, default=50)
+    parser.add_argument("--batch-size", type=int, default=256, help="the number of chunks embedded at once")
+    parser.add_argument("--workers", type=int, default=4, help="the number of embedding processes")
+    parser.add_argument("--index-type", default="Flat", choices=list(INDEX_TYPES))
+    parser.add_argument("--index-params", default="{}",
+                        help='JSON, e.g. \'{"nlist": 1024, "nprobe": 16}\' (see `utils/knowledge_builder.py`)')
+    args = parser.parse_args()
+
+    index_config = dict(json.loads(args.index_params), type=args.index_type)
+    build_knowledge_database(args.input_folder, args.name, output_folder=args.output_folder,
+                             embedding_model=args.embedding_model, chunk_size=args.chunk_size,
+                             chunk_overlap=args.chunk_overlap, batch_size=args.batch_size, workers=args.workers,
+                             index_config=index_config)
@@ -1,7 +1,8 @@
 from langchain.prompts import load_prompt
 import os
 
-def generate_paper_prompts(paper, section_name):
+
+def _load_paper_prompt(section_name):
     section_name = section_name.replace(" ", "_")
     try:
         cur_path = os.path.dirname(__file__)
@@ -9,5 +10,15 @@ def generate_paper_prompts(paper, section_name):
         prompt = load_prompt(target_path)
     except FileNotFoundError:
         raise ValueError(f"Cannot find the prompt for the section name {section_name}. Please check the folder `prompts`.")
+    return prompt
+
+
+def generate_paper_prompts(paper, section_name):
+    prompt = _load_paper_prompt(section_name)
     kw = {k: paper[k] for k in prompt.input_variables}
-    return prompt.format(**kw)
\ No newline at end of file
+    return prompt.format(**kw)
+
+
+def get_prompt_variables(section_name):
+    # return the keys of `paper` used by the prompt of `section_name`
+    return list(_load_paper_prompt(section_name).input_variables)
@@ -0,0 +1,48 @@
+# Tests of the duplicate detection of `PaperStore` (see `utils/paper_store.py`).
+#
+#   python -m pytest tests
+
+from utils.paper_store import PaperStore
+
+
+def _paper(paper_id, title, year="2016", authors="Volodymyr Mnih and Koray Kavukcuoglu", external_ids=None):
+    return {"paper_id": paper_id, "title": title, "authors": authors, "year": year, "link": "", "abstract": "",
+            "journal": "", "external_ids": external_ids or {}}
+
+
+def test_true_duplicates_are_merged():
+    store = PaperStore()
+    first = store.add(_paper("mnih2016asynchronous", "Asynchronous Methods for Deep Reinforcement Learning"),
+                      keyword="reinforcement learning")
+    # the same paper from a .bib file: another ID, LaTeX braces, "Last, First" authors and an extra DOI
+    second = store.add(_paper("Mnih16", "{Asynchronous} Methods for Deep Reinforcement-Learning.",
+                              authors="Mnih, Volodymyr and Badia, Adria Puigdomenech",
+                              external_ids={"DOI": "10.5555/3045390.3045594"}), keyword="a3c")
+    # a near-duplicate title without year or authors
+    third = store.add(_paper("a3c", "Asynchronous Method for Deep Reinforcement Learning", year="", authors=""))
+
+    assert first == second == third == "mnih2016asynchronous"
+    assert len(store) == 1
+    assert store.get("Mnih16")["external_ids"] == {"DOI": "10.5555/3045390.3045594"}
+    assert store.keywords["mnih2016asynchronous"] == {"reinforcement learning", "a3c"}
+
+
+def test_similar_titles_of_different_papers_are_not_merged():
+    store = PaperStore()
+    # Jaccard similarity of the titles: about 0.85, but the first authors and the years differ
+    store.add(_paper("li2017survey", "A Survey of Deep Reinforcement Learning", year="2017", authors="Yuxi Li"))
+    store.add(_paper("arulkumaran2017brief", "A Survey on Deep Reinforcement Learning", year="2017",
+                     authors="Kai Arulkumaran and Marc Peter Deisenroth"))
+    # Jaccard similarity of the titles: about 0.84, but the DOIs differ
+    store.add(_paper("mnih2016asynchronous", "Asynchronous Methods for Deep Reinforcement Learning",
+                     external_ids={"DOI": "10.5555/3045390.3045594"}))
+    store.add(_paper("mnih2016games", "Asynchronous Methods for Deep Reinforcement Learning in Games",
+                     external_ids={"DOI": "10.1000/games"}))
+    # the same title, but published in another year
+    store.add(_paper("mnih2013playing", "Playing Atari with Deep Reinforcement Learning", year="2013"))
+    store.add(_paper("mnih2015playing", "Playing Atari with Deep Reinforcement Learning", year="2015"))
+
+    assert len(store) == 6
+    assert store.find(_paper("x", "A Survey on Deep Reinforcement Learning", year="2017",
+                             authors="Arulkumaran, Kai")) == "arulkumaran2017brief"
+    assert store.find(_paper("y", "Playing Atari with Deep Reinforcement Learning", year="2015")) == "mnih2015playing"
@@ -0,0 +1,162 @@
+# Tests of `resolve_papers` (see `utils/references.py`) against a local stub server which stands in for both the
+# Semantic Scholar Graph API (`POST /paper/batch`, `GET /paper/search`) and the arXiv API (`GET /arxiv?id_list=...`).
+#
+#   python -m pytest tests
+
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+
+from utils import references
+from utils.cache import SQLiteCache
+from utils.rate_limit import RateLimiter
+
+
+def _ss_paper(title, external_ids):
+    return {"title": title, "abstract": f"The abstract of {title}.", "venue": "NeurIPS", "year": 2021,
+            "authors": [{"name": "Ada Lovelace"}], "tldr": None, "externalIds": external_ids}
+
+
+# the papers known by the stub Semantic Scholar API: {batch ID: raw paper}, {search query: raw paper}
+SS_PAPERS = {
+    "ARXIV:2106.15928": _ss_paper("A Paper Found by Its arXiv ID", {"ArXiv": "2106.15928"}),
+    "DOI:10.1000/found": _ss_paper("A Paper Found by Its DOI", {"DOI": "10.1000/found"}),
+}
+SS_SEARCH = {
+    "attention is all you need": _ss_paper("Attention Is All You Need", {"ArXiv": "1706.03762"}),
+}
+# the papers known by the stub arXiv API only: {arXiv ID: title}
+ARXIV_PAPERS = {
+    "2301.00001": "A Paper Only on arXiv",
+}
+
+ARXIV_FEED = """<?xml version="1.0" encoding="UTF-8"?>
+<feed xmlns="http://www.w3.org/2005/Atom" xmlns:opensearch="http://a9.com/-/spec/opensearch/1.1/"
+      xmlns:arxiv="http://arxiv.org/schemas/atom">
+  <title>arXiv Query</title>
+  <id>http://arxiv.org/api/stub</id>
+  <updated>2023-01-01T00:00:00-05:00</updated>
+  <opensearch:totalResults>{total}</opensearch:totalResults>
+  <opensearch:startIndex>0</opensearch:startIndex>
+  <opensearch:itemsPerPage>{total}</opensearch:itemsPerPage>
+  {entries}
+</feed>"""
+
+ARXIV_ENTRY = """<entry>
+    <id>http://arxiv.org/abs/{arxiv_id}v2</id>
+    <updated>2023-01-02T00:00:00Z</updated>
+    <published>2023-01-01T00:00:00Z</published>
+    <title>{title}</title>
+    <summary>The abstract of {title}.</summary>
+    <author><name>Grace Hopper</name></author>
+    <link href="http://arxiv.org/abs/{arxiv_id}v2" rel="alternate" type="text/html"/>
+    <link title="pdf" href="http://arxiv.org/pdf/{arxiv_id}v2" rel="related" type="application/pdf"/>
+    <arxiv:primary_category term="cs.LG" scheme="http://arxiv.org/schemas/atom"/>
+    <category term="cs.LG" scheme="http://arxiv.org/schemas/atom"/>
+  </entry>"""
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    # every request is recorded in `self.server.calls` as (method, path, query, JSON body)
+    def _reply(self, status, body, content_type="application/json"):
+        content = body.encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        self.server.calls.append(("POST", url.path, parse_qs(url.query), body))
+        if url.path != "/graph/v1/paper/batch":
+            return self._reply(404, "{}")
+        self._reply(200, json.dumps([SS_PAPERS.get(paper_id) for paper_id in body["ids"]]))
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        self.server.calls.append(("GET", url.path, query, None))
+        if url.path == "/graph/v1/paper/search":
+            paper = SS_SEARCH.get(query["query"][0].replace("+", " "))
+            self._reply(200, json.dumps({"total": 1, "data": [paper]} if paper else {"total": 0, "data": []}))
+        elif url.path == "/arxiv":
+            arxiv_ids = [arxiv_id for arxiv_id in query.get("id_list", [""])[0].split(",") if arxiv_id in ARXIV_PAPERS]
+            entries = [ARXIV_ENTRY.format(arxiv_id=arxiv_id, title=ARXIV_PAPERS[arxiv_id]) for arxiv_id in arxiv_ids]
+            self._reply(200, ARXIV_FEED.format(total=len(entries), entries="\n".join(entries)),
+                        content_type="application/atom+xml")
+        else:
+            self._reply(404, "{}")
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def stub_server(monkeypatch, tmp_path):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubHandler)
+    server.calls = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_address[1]}"
+    monkeypatch.setattr(references, "SS_API_URL", f"{base_url}/graph/v1")
+    monkeypatch.setattr(references.ARXIV_CLIENT, "query_url_format", f"{base_url}/arxiv?{{}}")
+    # a fresh cache and no rate limit, so every run sends the same requests
+    monkeypatch.setattr(references, "SS_CACHE", SQLiteCache(str(tmp_path / "ss_cache.sqlite")))
+    monkeypatch.setattr(references, "SS_RATE_LIMITER", RateLimiter({}))
+    monkeypatch.setattr(references, "OFFLINE", False)
+    # arXiv is never started as a hedge for the title searches
+    monkeypatch.setattr(references, "HEDGE_DELAY", 60.0)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_parse_reference_id():
+    assert references.parse_reference_id("arXiv:2106.15928v3") == ("ArXiv", "2106.15928")
+    assert references.parse_reference_id("https://arxiv.org/abs/2106.15928") == ("ArXiv", "2106.15928")
+    assert references.parse_reference_id("https://doi.org/10.1000/found") == ("DOI", "10.1000/found")
+    assert references.parse_reference_id("Attention Is All You Need") is None
+
+
+def test_resolve_papers(stub_server):
+    papers = references.resolve_papers(["arXiv:2106.15928",
+                                        "Attention Is All You Need",
+                                        "10.1000/found",
+                                        "2301.00001",
+                                        "doi:10.1000/missing"])
+
+    # in the order of the input; the reference found nowhere is dropped
+    assert [paper["title"] for paper in papers] == ["A Paper Found by Its arXiv ID",
+                                                    "Attention Is All You Need",
+                                                    "A Paper Found by Its DOI",
+                                                    "A Paper Only on arXiv"]
+    assert papers[3]["external_ids"] == {"ArXiv": "2301.00001"}
+    assert papers[3]["link"] == "http://arxiv.org/pdf/2301.00001v2"
+
+    calls = stub_server.calls
+    batch_calls = [call for call in calls if call[1] == "/graph/v1/paper/batch"]
+    search_calls = [call for call in calls if call[1] == "/graph/v1/paper/search"]
+    arxiv_calls = [call for call in calls if call[1] == "/arxiv"]
+    # all IDs go to one batch request; only the titles are searched
+    assert len(batch_calls) == 1
+    assert batch_calls[0][3] == {"ids": ["ARXIV:2106.15928", "DOI:10.1000/found", "ARXIV:2301.00001",
+                                         "DOI:10.1000/missing"]}
+    assert [call[2]["query"][0] for call in search_calls] == ["attention is all you need"]
+    # only the arXiv ID not returned by Semantic Scholar falls back to one arXiv `id_list` query
+    assert len(arxiv_calls) == 1
+    assert arxiv_calls[0][2]["id_list"] == ["2301.00001"]
+    assert len(calls) == 3
+
+
+def test_resolve_papers_uses_cache(stub_server):
+    references.resolve_papers(["arXiv:2106.15928", "10.1000/found"])
+    stub_server.calls.clear()
+    papers = references.resolve_papers(["arXiv:2106.15928", "10.1000/found"])
+
+    assert [paper["title"] for paper in papers] == ["A Paper Found by Its arXiv ID", "A Paper Found by Its DOI"]
+    assert stub_server.calls == []
@@ -0,0 +1,40 @@
+#!/usr/bin/env python
+# Update a knowledge database built by `build-knowledge-database.py` (see `utils/knowledge_builder.py`).
+#
+#   python update-knowledge-database.py append my_database path/to/documents
+#   python update-knowledge-database.py delete my_database paper.pdf notes/old.md
+#   python update-knowledge-database.py compact my_database
+#
+# Running processes load the new version of the database at their next query; they do not need a restart.
+
+import argparse
+
+from utils.knowledge_builder import append_documents, compact_knowledge_database, delete_sources
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Append, delete or compact the documents of a knowledge database.")
+    parser.add_argument("--output-folder", default="knowledge_databases")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    append_parser = subparsers.add_parser("append", help="add the new documents of a folder")
+    append_parser.add_argument("name", help="the name of the database")
+    append_parser.add_argument("input_folder", help="the folder of .pdf, .txt, .md and .tex files")
+    append_parser.add_argument("--batch-size", type=int, default=256, help="the number of chunks embedded at once")
+    append_parser.add_argument("--workers", type=int, default=4, help="the number of embedding processes")
+
+    delete_parser = subparsers.add_parser("delete", help="delete documents by their paths in the input folder")
+    delete_parser.add_argument("name", help="the name of the database")
+    delete_parser.add_argument("sources", nargs="+")
+
+    compact_parser = subparsers.add_parser("compact", help="remove the deleted chunks from the index")
+    compact_parser.add_argument("name", help="the name of the database")
+    args = parser.parse_args()
+
+    if args.command == "append":
+        append_documents(args.input_folder, args.name, output_folder=args.output_folder,
+                         batch_size=args.batch_size, workers=args.workers)
+    elif args.command == "delete":
+        # a background thread would not outlive this process
+        delete_sources(args.sources, args.name, output_folder=args.output_folder, background=False)
+    else:
+        compact_knowledge_database(args.name, output_folder=args.output_folder)
@@ -0,0 +1,163 @@
+# This script `bibtex.py` is used to read and write BibTeX files without loading the whole file into memory.
+#   `iter_bibtex_entries`:
+#       Parse a .bib file entry by entry. Each entry is a dictionary like the entries of `bibtexparser`:
+#           {"ENTRYTYPE": "article", "ID": "key", "title": "...", "author": "...", ...}
+#       The field names are lowercase, the outer braces/quotes of the values are removed and the whitespaces are
+#       collapsed. @comment, @preamble and @string entries are skipped (string macros are not expanded).
+#   `escape_latex`:
+#       Escape LaTeX special characters which are not escaped yet, so it can be applied to any text more than once.
+#   `format_entry` / `write_bibtex`:
+#       Turn papers (see `references.py`) into BibTeX entries, and write them into a .bib file in one buffered pass.
+
+import re
+
+_ENTRY_START = re.compile(r"@\s*(\w+)\s*\{")
+# an escaped character or a brace
+_BRACES = re.compile(r"\\.|[{}]")
+_FIELD = re.compile(r"\s*([\w\-:.]+)\s*=\s*")
+_BARE_VALUE = re.compile(r"[^,#\s}]+")
+_SKIPPED_ENTRY_TYPES = {"comment", "preamble", "string"}
+
+
+######################################################################################################################
+# Read
+######################################################################################################################
+def _iter_entry_texts(lines):
+    # yield the text of each entry, from "@" to the matching closing brace
+    buffer = None
+    depth = 0
+    for line in lines:
+        pos = 0
+        while True:
+            if buffer is None:
+                match = _ENTRY_START.search(line, pos)
+                if match is None:
+                    break
+                buffer, depth, pos = [], 0, match.start()
+            end = None
+            for match in _BRACES.finditer(line, pos):
+                if match.group() == "{":
+                    depth += 1
+                elif match.group() == "}":
+                    depth -= 1
+                    if depth == 0:
+                        end = match.end()
+                        break
+            if end is None:
+                buffer.append(line[pos:])
+                break
+            buffer.append(line[pos:end])
+            yield "".join(buffer)
+            buffer, pos = None, end
+
+
+def _read_delimited(text, pos):
+    # `text[pos]` is "{" or '"'; return (the value without the delimiters, the position after it)
+    depth = 0
+    quoted = text[pos] == '"'
+    i = pos + 1 if quoted else pos
+    while i < len(text):
+        c = text[i]
+        if c == "\\":
+            i += 2
+            continue
+        if c == "{":
+            depth += 1
+        elif c == "}":
+            depth -= 1
+            if depth == 0 and not quoted:
+                return text[pos + 1: i], i + 1
+        elif c == '"' and quoted and depth == 0:
+            return text[pos + 1: i], i + 1
+        i += 1
+    return text[pos + 1:], len(text)
+
+
+def _parse_value(text, pos):
+    parts = []
+    while pos < len(text):
+        if text[pos] in "{\"":
+            value, pos = _read_delimited(text, pos)
+        else:
+            match = _BARE_VALUE.match(text, pos)
+            if match is None:
+                break
+            value, pos = match.group(), match.end()
+        parts.append(value)
+        # values can be concatenated by "#"
+        while pos < len(text) and text[pos].isspace():
+            pos += 1
+        if pos < len(text) and text[pos] == "#":
+            pos += 1
+            while pos < len(text) and text[pos].isspace():
+                pos += 1
+        else:
+            break
+    return " ".join("".join(parts).split()), pos
+
+
+def parse_entry(text):
+    match = _ENTRY_START.match(text)
+    if match is None or match.group(1).lower() in _SKIPPED_ENTRY_TYPES:
+        return None
+    body = text[match.end(): -1]
+    key, _, fields = body.partition(",")
+    entry = {"ENTRYTYPE": match.group(1).lower(), "ID": key.strip()}
+    pos = 0
+    while True:
+        match = _FIELD.match(fields, pos)
+        if match is None:
+            break
+        value, pos = _parse_value(fields, match.end())
+        entry[match.group(1).lower()] = value
+        comma = fields.find(",", pos)
+        if comma < 0:
+            break
+        pos = comma + 1
+    return entry
+
+
+def iter_bibtex_entries(bib_file_path, encoding="utf-8"):
+    with open(bib_file_path, "r", encoding=encoding, errors="replace") as f:
+        for text in _iter_entry_texts(f):
+            entry = parse_entry(text)
+            if entry is not None and entry["ID"]:
+                yield entry
+
+
+######################################################################################################################
+# Write
+######################################################################################################################
+def escape_latex(text):
+    # "&", "%" and "#" are always escaped; "_" is escaped only if the text has no math ("$")
+    if text is None:
+        return ""
+    text = re.sub(r"(?<!\\)([&%#])", r"\\\1", str(text))
+    if "$" not in text:
+        text = re.sub(r"(?<!\\)_", r"\\_", text)
+    return text
+
+
+def format_entry(paper):
+    return f"""@article{{{paper["paper_id"]},
+          title = {{{escape_latex(paper["title"])}}},
+          author = {{{escape_latex(paper["authors"])}}},
+          journal={{{escape_latex(paper["journal"])}}},
+          year = {{{paper["year"]}}},
+          url = {{{paper["link"]}}}
+        }}"""
+
+
+def write_bibtex(papers, path_to_bibtex):
+    # write all entries in one pass; return the list of `paper_id` (papers with the same `paper_id` are written once)
+    paper_ids = []
+    seen = set()
+    with open(path_to_bibtex, "w", encoding="utf-8", buffering=1 << 16) as file:
+        for paper in papers:
+            if paper["paper_id"] in seen:
+                continue
+            seen.add(paper["paper_id"])
+            file.write(format_entry(paper))
+            file.write("\n\n")
+            paper_ids.append(paper["paper_id"])
+    return paper_ids
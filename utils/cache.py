@@ -0,0 +1,293 @@
+# This script `cache.py` is used to cache results on the disk.
+#   `SQLiteCache`:
+#       A content-addressed key-value store backed by SQLite. Values are saved as JSON.
+#       Supports TTL (`ttl` in seconds), size bound (`max_entries`, least recently used entries are evicted first)
+#       and hit/miss counters. It can be safely shared by many threads.
+#   `make_key`:
+#       Hash any JSON-serializable objects into a cache key.
+#   `LLM_CACHE`:
+#       The cache used by `GPTModel`. It is configured by the environment variables:
+#           AUTO_DRAFT_CACHE_DIR: the folder of cache files. Defaults to ".cache".
+#           AUTO_DRAFT_LLM_CACHE: set it to 0 to bypass the cache.
+#           AUTO_DRAFT_LLM_CACHE_TTL: TTL in seconds. Defaults to 7 days.
+#           AUTO_DRAFT_LLM_CACHE_SIZE: the maximum number of entries. Defaults to 10000.
+#   `SS_CACHE`:
+#       The cache of Semantic Scholar search responses. It is configured by:
+#           AUTO_DRAFT_SS_CACHE: set it to 0 to bypass the cache.
+#           AUTO_DRAFT_SS_CACHE_TTL: TTL in seconds. Defaults to 7 days.
+#           AUTO_DRAFT_SS_CACHE_SIZE: the maximum number of entries. Defaults to 100000.
+#           AUTO_DRAFT_OFFLINE: set it to 1 to use the caches read-only and never access the network (`OFFLINE`).
+#   `EmbeddingStore` / `embedding_store(name)`:
+#       Float32 vectors (e.g. the embeddings of papers by one model) in a memory-mapped file, with a small SQLite index
+#       {key: row}. Only the rows which are read are loaded into memory. `embedding_store` returns the store of one
+#       embedding model in CACHE_DIR/embeddings. Set AUTO_DRAFT_EMBEDDING_CACHE to 0 to bypass these stores.
+#   `StageStore`:
+#       Saves the output of each stage of one generation run in the run folder, keyed by the hash of its inputs, so
+#       that a failed or changed run can be resumed without computing the unchanged stages again.
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+
+CACHE_DIR = os.getenv("AUTO_DRAFT_CACHE_DIR", ".cache")
+
+
+def make_key(*parts):
+    content = json.dumps(parts, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+class SQLiteCache:
+    def __init__(self, path, ttl=None, max_entries=None, enabled=True, evict_every=100, read_only=False):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.enabled = enabled
+        # in read-only mode, entries are never added, updated or evicted
+        self.read_only = read_only
+        self.evict_every = evict_every
+        self.hits = 0
+        self.misses = 0
+        self._writes = 0
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        # the database is opened lazily, so importing this module never touches the disk
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, value TEXT NOT NULL, "
+                               "created REAL NOT NULL, accessed REAL NOT NULL)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute("SELECT value, created FROM cache WHERE key = ?", (key,)).fetchone()
+            if row is not None and self.ttl is not None and now - row[1] > self.ttl:
+                if not self.read_only:
+                    conn.execute("DELETE FROM cache WHERE key = ?", (key,))
+                    conn.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            if not self.read_only:
+                conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+                conn.commit()
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key, value):
+        if not self.enabled or self.read_only:
+            return
+        now = time.time()
+        content = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            conn = self._connect()
+            conn.execute("INSERT OR REPLACE INTO cache (key, value, created, accessed) VALUES (?, ?, ?, ?)",
+                         (key, content, now, now))
+            conn.commit()
+            self._writes += 1
+            if self._writes % self.evict_every == 0:
+                self._evict(conn)
+
+    def evict(self):
+        with self._lock:
+            self._evict(self._connect())
+
+    def _evict(self, conn):
+        if self.ttl is not None:
+            conn.execute("DELETE FROM cache WHERE created < ?", (time.time() - self.ttl,))
+        if self.max_entries is not None:
+            conn.execute("DELETE FROM cache WHERE key IN "
+                         "(SELECT key FROM cache ORDER BY accessed DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+        conn.commit()
+
+    def clear(self):
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM cache")
+            conn.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {"hits": self.hits, "misses": self.misses, "hit_rate": self.hits / total if total else 0.0}
+
+
+LLM_CACHE = SQLiteCache(os.path.join(CACHE_DIR, "llm_cache.sqlite"),
+                        ttl=float(os.getenv("AUTO_DRAFT_LLM_CACHE_TTL", 7 * 24 * 3600)),
+                        max_entries=int(os.getenv("AUTO_DRAFT_LLM_CACHE_SIZE", 10000)),
+                        enabled=os.getenv("AUTO_DRAFT_LLM_CACHE", "1") != "0")
+
+OFFLINE = os.getenv("AUTO_DRAFT_OFFLINE", "0") == "1"
+SS_CACHE = SQLiteCache(os.path.join(CACHE_DIR, "ss_cache.sqlite"),
+                       ttl=float(os.getenv("AUTO_DRAFT_SS_CACHE_TTL", 7 * 24 * 3600)),
+                       max_entries=int(os.getenv("AUTO_DRAFT_SS_CACHE_SIZE", 100000)),
+                       enabled=OFFLINE or os.getenv("AUTO_DRAFT_SS_CACHE", "1") != "0",
+                       read_only=OFFLINE)
+
+
+class EmbeddingStore:
+    """
+    Vectors are appended to `<path>.f32` (one float32 row per vector) and the index {key: row} and the size of the
+    vectors are saved in `<path>.sqlite`. Rows never change after they are written, so the file can be memory-mapped
+    and shared by all processes. Writers are serialized by `BEGIN IMMEDIATE`.
+    """
+    def __init__(self, path, enabled=True, read_only=False):
+        self.path = path
+        self.enabled = enabled
+        self.read_only = read_only
+        self.dim = None
+        self._matrix = None
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            # autocommit mode; transactions are opened explicitly by `BEGIN IMMEDIATE`
+            self._conn = sqlite3.connect(f"{self.path}.sqlite", timeout=30, check_same_thread=False,
+                                         isolation_level=None)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self._conn.execute("CREATE TABLE IF NOT EXISTS rows (key TEXT PRIMARY KEY, row INTEGER NOT NULL)")
+        if self.dim is None:
+            row = self._conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+            if row is not None:
+                self.dim = row[0]
+        return self._conn
+
+    def _rows(self, conn, keys):
+        rows = {}
+        keys = list(keys)
+        # SQLite limits the number of parameters of one statement
+        for start in range(0, len(keys), 500):
+            batch = keys[start: start + 500]
+            rows.update(conn.execute(f"SELECT key, row FROM rows WHERE key IN ({','.join('?' * len(batch))})",
+                                     batch).fetchall())
+        return rows
+
+    def _map(self, num_rows):
+        # map the file again if rows were appended after it was mapped
+        if self._matrix is None or self._matrix.shape[0] < num_rows:
+            total_rows = os.path.getsize(f"{self.path}.f32") // (4 * self.dim)
+            self._matrix = np.memmap(f"{self.path}.f32", dtype=np.float32, mode="r", shape=(total_rows, self.dim))
+        return self._matrix
+
+    def get_many(self, keys):
+        """Return {key: vector} of the keys found in the store."""
+        if not self.enabled:
+            return {}
+        with self._lock:
+            conn = self._connect()
+            if self.dim is None:
+                return {}
+            rows = self._rows(conn, set(keys))
+            if not rows:
+                return {}
+            matrix = self._map(max(rows.values()) + 1)
+            return {key: np.array(matrix[row]) for key, row in rows.items()}
+
+    def put_many(self, vectors):
+        """Save {key: vector}. Keys which are already saved are skipped."""
+        if not self.enabled or self.read_only or not vectors:
+            return
+        with self._lock:
+            conn = self._connect()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.dim is None:
+                    self.dim = len(next(iter(vectors.values())))
+                    conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (self.dim,))
+                existing = self._rows(conn, vectors)
+                new = {key: vector for key, vector in vectors.items()
+                       if key not in existing and len(vector) == self.dim}
+                if new:
+                    data_path = f"{self.path}.f32"
+                    row_size = 4 * self.dim
+                    size = os.path.getsize(data_path) if os.path.exists(data_path) else 0
+                    if size % row_size:
+                        # a partial row written by a crashed process; it is not in the index
+                        os.truncate(data_path, size - size % row_size)
+                    start = size // row_size
+                    with open(data_path, "ab") as f:
+                        f.write(np.asarray(list(new.values()), dtype=np.float32).tobytes())
+                    conn.executemany("INSERT INTO rows (key, row) VALUES (?, ?)",
+                                     [(key, start + i) for i, key in enumerate(new)])
+                conn.execute("COMMIT")
+            except Exception:
+                conn.execute("ROLLBACK")
+                raise
+
+
+_EMBEDDING_STORES = {}
+_EMBEDDING_STORES_LOCK = threading.Lock()
+
+
+def embedding_store(name):
+    with _EMBEDDING_STORES_LOCK:
+        if name not in _EMBEDDING_STORES:
+            _EMBEDDING_STORES[name] = EmbeddingStore(os.path.join(CACHE_DIR, "embeddings", name),
+                                                     enabled=os.getenv("AUTO_DRAFT_EMBEDDING_CACHE", "1") != "0",
+                                                     read_only=OFFLINE)
+        return _EMBEDDING_STORES[name]
+
+
+class StageStore:
+    """
+    Saves the output of each generation stage in `folder` (e.g. `<run folder>/stages`), keyed by the hash of the
+    stage's inputs. Running the stage again with the same inputs loads the saved output instead.
+    If `folder` is None, nothing is saved and every stage is computed.
+    """
+    def __init__(self, folder=None):
+        self.folder = folder
+
+    def _path(self, stage, key):
+        return os.path.join(self.folder, stage.replace(" ", "_"), f"{key}.json")
+
+    def get(self, stage, inputs):
+        # return (found, output)
+        if self.folder is None:
+            return False, None
+        path = self._path(stage, make_key(stage, inputs))
+        if not os.path.isfile(path):
+            return False, None
+        with open(path, "r", encoding="utf-8") as f:
+            return True, json.load(f)["output"]
+
+    def set(self, stage, inputs, output):
+        if self.folder is None:
+            return
+        path = self._path(stage, make_key(stage, inputs))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"stage": stage, "inputs": inputs, "output": output}, f, ensure_ascii=False)
+        os.replace(tmp_path, path)
+
+    def memoize(self, stage, inputs, compute, before_compute=None):
+        # `before_compute` (e.g. a budget check) is only called if the output is not saved
+        found, output = self.get(stage, inputs)
+        if found:
+            print(f"Stage {stage} is loaded from the saved outputs.")
+            return output
+        if before_compute is not None:
+            before_compute()
+        output = compute()
+        self.set(stage, inputs, output)
+        return output
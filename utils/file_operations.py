@@ -36,16 +36,20 @@ def make_archive(source, destination):
     shutil.move('%s.%s'%(name,format), destination)
     return destination
 
-def copy_templates(template, title):
+def copy_templates(template, title, destination_folder=None):
     # Create a copy in the outputs folder.
-    #   1. create a folder "outputs_%Y%m%d_%H%M%S" (destination_folder)
+    #   1. create a folder "outputs_%Y%m%d_%H%M%S_%f" (destination_folder)
     #   2. copy all contents in "latex_templates/{template}" to that folder
     #   3. return (bibtex_path, destination_folder)
-    now = datetime.datetime.now()
-    target_name = now.strftime("outputs_%Y%m%d_%H%M%S")
+    # If `destination_folder` is given (e.g. to resume a previous run), the template is copied into it and
+    #   existing files are overwritten.
+    if destination_folder is None:
+        now = datetime.datetime.now()
+        # microseconds are included so that concurrent runs never share a folder
+        target_name = now.strftime("outputs_%Y%m%d_%H%M%S_%f")
+        destination_folder = f"outputs/{target_name}"
     source_folder = f"latex_templates/{template}"
-    destination_folder = f"outputs/{target_name}"
-    shutil.copytree(source_folder, destination_folder)
+    shutil.copytree(source_folder, destination_folder, dirs_exist_ok=True)
     bibtex_path = os.path.join(destination_folder, "ref.bib")
     # bibtex_path = destination_folder + "/ref.bib"
     replace_title(destination_folder, title)
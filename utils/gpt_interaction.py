@@ -1,103 +1,406 @@
+import asyncio
+import contextlib
+import email.utils
+import functools
 import os
+import queue
+import random
+import threading
 import time
 
+import aiohttp
 import openai
+import tiktoken
 import logging
-import requests
 import json
 
+from utils.cache import LLM_CACHE, make_key
+from utils.rate_limit import RATE_LIMITER
+from utils.tracing import span
+
 log = logging.getLogger(__name__)
 
+RETRY_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+######################################################################################################################
+# Async client
+######################################################################################################################
+def _parse_retry_after(value):
+    # `Retry-After` is either a number of seconds or an HTTP date
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class AsyncLLMClient:
+    """
+    Asyncio client for the chat completion API. It keeps one `aiohttp` session (a keep-alive connection pool) per
+    event loop, and retries failed requests with exponential backoff and jitter. `Retry-After` is honored.
+
+    If `url` or `key` is not given, `openai.api_base` and `openai.api_key` are used when sending each request, so
+    changing them at runtime (e.g. in `app.py`) still works.
+
+    Before each request, it waits for the `rate_limiter` (requests and prompt tokens per minute of the model), which
+    is shared by all threads and, by default, all processes on this host.
+    """
+    def __init__(self, url=None, key=None, max_connections=64, timeout=600, max_attempts=5, delay=2,
+                 max_delay=60, rate_limiter=RATE_LIMITER):
+        self.url = url
+        self.key = key
+        self.max_connections = max_connections
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.delay = delay
+        self.max_delay = max_delay
+        self.rate_limiter = rate_limiter
+        self._sessions = {}
+
+    def _get_session(self):
+        loop = asyncio.get_running_loop()
+        session = self._sessions.get(loop)
+        if session is None or session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            session = aiohttp.ClientSession(connector=connector,
+                                            timeout=aiohttp.ClientTimeout(total=self.timeout))
+            self._sessions[loop] = session
+        return session
+
+    def _request_info(self):
+        url = self.url
+        if url is None:
+            url = (openai.api_base or "https://api.openai.com/v1").rstrip("/") + "/chat/completions"
+        key = self.key or openai.api_key or os.getenv("OPENAI_API_KEY")
+        headers = {"Content-Type": "application/json; charset=utf-8", "Authorization": f"Bearer {key}"}
+        return url, headers
+
+    async def _wait_for_rate_limit(self, data):
+        if self.rate_limiter is None:
+            return
+        tokens = sum(_token_len(data["model"], message["content"]) for message in data["messages"])
+        await self.rate_limiter.acquire(data["model"], tokens)
+
+    def _backoff(self, attempt, delay, retry_after=None):
+        if retry_after is not None:
+            return retry_after + random.uniform(0, 1)
+        # exponential backoff with full jitter
+        return random.uniform(0, min(self.max_delay, delay * 2 ** attempt))
+
+    def _check_status(self, response, text):
+        # return (error, retry_after) for a retryable failure; raise for the others
+        error = f"HTTP {response.status}: {text}"
+        if response.status not in RETRY_STATUS:
+            raise RuntimeError(f"Failed to get response from OpenAI. {error}")
+        return error, _parse_retry_after(response.headers.get("Retry-After"))
+
+    async def chat(self, data, max_attempts=None, delay=None, info=None):
+        """
+        Send the request body `data` and return the decoded response.
+        If `info` (a dictionary) is given, the number of retries is saved in `info["retries"]`.
+        """
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        if delay is None:
+            delay = self.delay
+        url, headers = self._request_info()
+        session = self._get_session()
+        error = None
+        for attempt in range(max_attempts):
+            retry_after = None
+            await self._wait_for_rate_limit(data)
+            try:
+                async with session.post(url, headers=headers, json=data) as response:
+                    if response.status == 200:
+                        if info is not None:
+                            info["retries"] = attempt
+                        try:
+                            return await response.json(content_type=None)
+                        except (aiohttp.ContentTypeError, json.JSONDecodeError) as e:
+                            raise RuntimeError(f"Failed to decode the response from OpenAI "
+                                               f"(HTTP {response.status}). Error: {e}")
+                    error, retry_after = self._check_status(response, await response.text())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e
+            if attempt + 1 < max_attempts:
+                wait = self._backoff(attempt, delay, retry_after)
+                print(f"Failed to get response. Error: {error}. Retry in {wait:.1f} seconds.")
+                await asyncio.sleep(wait)
+        raise RuntimeError(f"Failed to get response from OpenAI. Error: {error}")
+
+    async def stream_chat(self, data, max_attempts=None, delay=None, info=None):
+        """
+        Send the request body `data` with `stream=True` and yield the content of each delta as it arrives.
+        The request is retried only before the first token; an error after that is raised.
+        If `info` (a dictionary) is given, the number of retries is saved in `info["retries"]`.
+        """
+        if max_attempts is None:
+            max_attempts = self.max_attempts
+        if delay is None:
+            delay = self.delay
+        data = dict(data, stream=True)
+        url, headers = self._request_info()
+        session = self._get_session()
+        error = None
+        for attempt in range(max_attempts):
+            retry_after = None
+            started = False
+            await self._wait_for_rate_limit(data)
+            try:
+                async with session.post(url, headers=headers, json=data) as response:
+                    if response.status == 200:
+                        if info is not None:
+                            info["retries"] = attempt
+                        # server-sent events: each line looks like `data: {...}` and the last one is `data: [DONE]`
+                        async for line in response.content:
+                            line = line.decode("utf-8").strip()
+                            if not line.startswith("data:"):
+                                continue
+                            payload = line[len("data:"):].strip()
+                            if payload == "[DONE]":
+                                return
+                            choices = json.loads(payload).get("choices") or [{}]
+                            delta = choices[0].get("delta", {}).get("content")
+                            if delta:
+                                started = True
+                                yield delta
+                        return
+                    error, retry_after = self._check_status(response, await response.text())
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                if started:
+                    raise RuntimeError(f"The response stream from OpenAI is interrupted. Error: {e}")
+                error = e
+            if attempt + 1 < max_attempts:
+                wait = self._backoff(attempt, delay, retry_after)
+                print(f"Failed to get response. Error: {error}. Retry in {wait:.1f} seconds.")
+                await asyncio.sleep(wait)
+        raise RuntimeError(f"Failed to get response from OpenAI. Error: {error}")
+
+    async def close(self):
+        for session in self._sessions.values():
+            await session.close()
+        self._sessions = {}
+
+
+# All sync calls share one event loop running in a background thread, so that they share one connection pool.
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _get_loop():
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(target=_LOOP.run_forever, name="llm-client-loop", daemon=True).start()
+    return _LOOP
+
+
+def run_sync(coroutine):
+    """Run `coroutine` in the shared background event loop and wait for its result."""
+    return asyncio.run_coroutine_threadsafe(coroutine, _get_loop()).result()
+
+
+DEFAULT_CLIENT = AsyncLLMClient()
+_STREAM_END = object()
+
+
+@functools.lru_cache(maxsize=None)
+def _encoding(model):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def _token_len(model, text):
+    return len(_encoding(model).encode(text, disallowed_special=()))
+
+
+######################################################################################################################
+# GPT models
+######################################################################################################################
 class GPTModel:
     def __init__(self, model="gpt-3.5-turbo", temperature=0.9, presence_penalty=0,
-                 frequency_penalty=0, max_attempts=1, delay=20):
+                 frequency_penalty=0, max_attempts=5, delay=2, client=None, use_cache=True, cache=None):
         self.model = model
         self.temperature = temperature
         self.presence_penalty = presence_penalty
         self.frequency_penalty = frequency_penalty
         self.max_attempts = max_attempts
         self.delay = delay
+        self.client = DEFAULT_CLIENT if client is None else client
+        # responses are cached by the hash of the request body (model, prompts and sampling parameters)
+        self.use_cache = use_cache
+        self.cache = LLM_CACHE if cache is None else cache
+
+    def _request_data(self, systems, prompts):
+        # the request body is also used as the cache key, so streaming and non-streaming calls share the cache
+        return {
+            "model": self.model,
+            "messages": [
+                {"role": "system", "content": systems},
+                {"role": "user", "content": prompts}
+            ],
+            "n": 1,
+            "temperature": self.temperature,
+            "presence_penalty": self.presence_penalty,
+            "frequency_penalty": self.frequency_penalty,
+            "stream": False
+        }
+
+    async def acall(self, systems, prompts, return_json=False):
+        data = self._request_data(systems, prompts)
+        key = make_key(data) if self.use_cache else None
+        response = self.cache.get(key) if key is not None else None
+        cached = response is not None
+        info = {}
+        start = time.perf_counter()
+        if not cached:
+            response = await self.client.chat(data, max_attempts=self.max_attempts, delay=self.delay, info=info)
+        latency = time.perf_counter() - start
+        try:
+            assistant_message = response['choices'][0]["message"]["content"]
+            usage = dict(response['usage'])
+        except (KeyError, IndexError, TypeError):
+            raise RuntimeError(f"Failed to get response from OpenAI. Response: {response}")
+        log.info(assistant_message)
+        if return_json:
+            assistant_message = json.loads(assistant_message)
+        usage.update(latency=latency, time_to_first_token=latency, retries=info.get("retries", 0))
+        if cached:
+            usage["cached"] = True
+        elif key is not None:
+            # only cache the responses which can be parsed
+            self.cache.set(key, response)
+        return assistant_message, usage
 
     def __call__(self, systems, prompts, return_json=False):
-        conversation_history = [
-            {"role": "system", "content": systems},
-            {"role": "user", "content": prompts}
-        ]
-        for _ in range(self.max_attempts):
+        with span("llm.chat", model=self.model):
+            return run_sync(self.acall(systems, prompts, return_json=return_json))
+
+    def batch(self, requests, return_json=False):
+        """
+        Send many requests at once. `requests` is a list of (systems, prompts).
+        Return a list of (assistant_message, usage) in the same order.
+        """
+        async def _gather():
+            return await asyncio.gather(*[self.acall(systems, prompts, return_json=return_json)
+                                          for systems, prompts in requests])
+        with span("llm.batch", model=self.model, requests=len(requests)):
+            return run_sync(_gather())
+
+    ##################################################################################################################
+    # Streaming
+    ##################################################################################################################
+    async def astream(self, systems, prompts, info=None):
+        """
+        Async generator of the tokens of the response. If the response is in the cache, it is yielded at once and
+        `info["cached"]` is set to True. The response is cached only if the stream is fully consumed.
+        """
+        data = self._request_data(systems, prompts)
+        key = make_key(data) if self.use_cache else None
+        response = self.cache.get(key) if key is not None else None
+        if response is not None:
+            if info is not None:
+                info["cached"] = True
+            yield response['choices'][0]["message"]["content"]
+            return
+        tokens = []
+        async for token in self.client.stream_chat(data, max_attempts=self.max_attempts, delay=self.delay,
+                                                   info=info):
+            tokens.append(token)
+            yield token
+        if key is not None:
+            message = "".join(tokens)
+            self.cache.set(key, {"choices": [{"message": {"role": "assistant", "content": message}}],
+                                 "usage": self._estimate_usage(systems, prompts, message)})
+
+    def iter_stream(self, systems, prompts, info=None):
+        """
+        Sync generator of the tokens of the response. The tokens are received in the shared event loop and handed
+        over through a queue. Closing the generator cancels the request.
+        """
+        tokens = queue.Queue()
+
+        async def _produce():
             try:
-                response = openai.ChatCompletion.create(
-                    model=self.model,
-                    messages=conversation_history,
-                    n=1,
-                    temperature=self.temperature,
-                    presence_penalty=self.presence_penalty,
-                    frequency_penalty=self.frequency_penalty,
-                    stream=False
-                )
-                assistant_message = response['choices'][0]["message"]["content"]
-                usage = response['usage']
-                log.info(assistant_message)
-                if return_json:
-                    assistant_message = json.loads(assistant_message)
-                return assistant_message, usage
-            except openai.error.APIConnectionError as e:
-                print(f"Failed to get response. Error: {e}")
-                time.sleep(self.delay)
-        raise RuntimeError("Failed to get response from OpenAI.")
-
-class GPTModel_API2D_SUPPORT:
+                async for token in self.astream(systems, prompts, info=info):
+                    tokens.put(token)
+            except Exception as e:
+                tokens.put(e)
+            else:
+                tokens.put(_STREAM_END)
+
+        future = asyncio.run_coroutine_threadsafe(_produce(), _get_loop())
+        try:
+            while True:
+                token = tokens.get()
+                if token is _STREAM_END:
+                    return
+                if isinstance(token, Exception):
+                    raise token
+                yield token
+        finally:
+            future.cancel()
+
+    def stream(self, systems, prompts, callback=None):
+        """
+        Streaming version of `__call__`. `callback(token)` is called in the current thread for each token;
+        if it returns False, the generation is aborted and the partial response is returned.
+        Return (assistant_message, usage); since the API does not report usage for streams, it is estimated.
+        """
+        info = {}
+        message = []
+        time_to_first_token = None
+        start = time.perf_counter()
+        with span("llm.stream", model=self.model), \
+                contextlib.closing(self.iter_stream(systems, prompts, info=info)) as tokens:
+            for token in tokens:
+                if time_to_first_token is None:
+                    time_to_first_token = time.perf_counter() - start
+                message.append(token)
+                if callback is not None and callback(token) is False:
+                    log.info("The generation is aborted by the callback.")
+                    break
+        message = "".join(message)
+        log.info(message)
+        usage = self._estimate_usage(systems, prompts, message)
+        usage.update(latency=time.perf_counter() - start, time_to_first_token=time_to_first_token,
+                     retries=info.get("retries", 0))
+        if info.get("cached"):
+            usage["cached"] = True
+        return message, usage
+
+    def _estimate_usage(self, systems, prompts, message):
+        # each message costs a few extra tokens for its role and separators
+        prompt_tokens = _token_len(self.model, systems) + _token_len(self.model, prompts) + 7
+        completion_tokens = _token_len(self.model, message)
+        return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens}
+
+
+class GPTModel_API2D_SUPPORT(GPTModel):
     def __init__(self, model="gpt-4", temperature=0, presence_penalty=0,
-                 frequency_penalty=0, url=None, key=None, max_attempts=1, delay=20):
+                 frequency_penalty=0, url=None, key=None, max_attempts=5, delay=2, use_cache=True):
         if url is None:
             url = "https://api.openai.com/v1/chat/completions"
         if key is None:
             key = os.getenv("OPENAI_API_KEY")
-
-        self.model = model
-        self.temperature = temperature
         self.url = url
         self.key = key
-        self.presence_penalty = presence_penalty
-        self.frequency_penalty = frequency_penalty
-        self.max_attempts = max_attempts
-        self.delay = delay
-
-    def __call__(self, systems, prompts, return_json=False):
-        headers = {
-            "Content-Type": "application/json",
-            "Authorization": f"Bearer {self.key}",
-            'Content-type': 'text/plain; charset=utf-8'
-        }
+        super().__init__(model=model, temperature=temperature, presence_penalty=presence_penalty,
+                         frequency_penalty=frequency_penalty, max_attempts=max_attempts, delay=delay,
+                         client=AsyncLLMClient(url=url, key=key), use_cache=use_cache)
 
-        data = {
-                "model": f"{self.model}",
-                "messages": [
-                {"role": "system", "content": systems},
-                {"role": "user", "content": prompts}],
-                "temperature": self.temperature,
-                "n": 1,
-                "stream": False,
-                "presence_penalty": self.presence_penalty,
-                "frequency_penalty": self.frequency_penalty
-                }
-        for _ in range(self.max_attempts):
-            try:
-                # todo: in some cases, UnicodeEncodeError is raised:
-                #   'gbk' codec can't encode character '\xdf' in position 1898: illegal multibyte sequence
-                response = requests.post(self.url, headers=headers, data=json.dumps(data))
-                response = response.json()
-                assistant_message = response['choices'][0]["message"]["content"]
-                usage = response['usage']
-                log.info(assistant_message)
-                if return_json:
-                    assistant_message = json.loads(assistant_message)
-                return assistant_message, usage
-            except Exception as e:
-                print(f"Failed to get response. Error: {e}")
-                time.sleep(self.delay)
-        raise RuntimeError("Failed to get response from OpenAI.")
 
 if __name__ == "__main__":
     bot = GPTModel(model="gpt-3.5-turbo-16k")
     r = bot("You are an assistant.", "Hello.")
-    print(r)
\ No newline at end of file
+    print(r)
@@ -1,6 +1,17 @@
+import json
+import os
+import pickle
+import threading
+from collections import OrderedDict
+
+import numpy as np
 import tiktoken
 from random import shuffle
 
+from utils.tracing import span, traced
+
+KNOWLEDGE_DATABASES_DIR = "knowledge_databases"
+
 # `tokenizer`: used to count how many tokens
 tokenizer_name = tiktoken.encoding_for_model('gpt-4')
 tokenizer = tiktoken.get_encoding(tokenizer_name.name)
@@ -11,27 +22,227 @@ def tiktoken_len(text):
     return len(tokens)
 
 
+def apply_search_parameters(index, index_config):
+    # `index_config`: the "index" of `db_meta.json`, e.g. {"type": "IVF-Flat", "nlist": 1024, "nprobe": 16}
+    import faiss
+    parameter_space = faiss.ParameterSpace()
+    for name in ("nprobe", "efSearch"):
+        if name in index_config:
+            parameter_space.set_index_parameter(index, name, index_config[name])
+
+
+def search_parameters(index, deleted):
+    # the parameters of `index.search` which skip the ids in `deleted` inside the search (None if nothing is deleted);
+    # the search parameters of the index ("nprobe", "efSearch") are kept, since the given parameters override them
+    import faiss
+    if not deleted:
+        return None
+    batch = faiss.IDSelectorBatch(np.asarray(sorted(deleted), dtype=np.int64))
+    selector = faiss.IDSelectorNot(batch)
+    if isinstance(index, faiss.IndexIVF):
+        params = faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    elif isinstance(index, faiss.IndexHNSW):
+        params = faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    else:
+        params = faiss.SearchParameters(sel=selector)
+    # the selectors are only referenced by C++ pointers; keep them alive as long as `params`
+    params.referenced_objects = [batch, selector]
+    return params
+
+
+def read_db_meta(db_path):
+    with open(os.path.join(db_path, "db_meta.json"), "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def index_folder(db_path, db_config):
+    # updated databases save each version of the index in a new folder (see `knowledge_builder.py`)
+    return os.path.join(db_path, db_config.get("index_folder", "faiss_index"))
+
+
+class KnowledgeDatabaseRegistry:
+    """
+    Loaded knowledge databases (`knowledge_databases/{name}`), shared by all runs in this process.
+    Each database is loaded once and kept in an LRU; the least recently used databases are dropped when the
+    estimated memory of all loaded databases goes over `memory_limit` bytes (the last loaded one is always kept).
+    If `use_mmap` is True, the inverted lists of IVF indexes are memory-mapped, so the processes on one host share
+    their pages and they are not counted in the memory. Other index types (Flat, HNSW) are always read into memory.
+    When `db_meta.json` of a loaded database gets a new "version", the database is swapped to the new version on the
+    next `get` (only the deleted chunks are updated if the index itself is unchanged).
+    """
+    def __init__(self, root=KNOWLEDGE_DATABASES_DIR, memory_limit=None, use_mmap=True):
+        self.root = root
+        self.memory_limit = memory_limit
+        self.use_mmap = use_mmap
+        self._databases = OrderedDict()  # {name: {"db": FAISS, "config": dict, "embeddings": ..., "size": bytes}}
+        self._lock = threading.Lock()
+
+    def get(self, name):
+        """Return (db, db_config); raise FileNotFoundError if the database doesn't exist."""
+        entry = self.get_entry(name)
+        return entry["db"], entry["config"]
+
+    def get_entry(self, name):
+        with self._lock:
+            if name in self._databases:
+                self._databases.move_to_end(name)
+                entry = self._refresh(name, self._databases[name])
+                self._databases[name] = entry
+                return entry
+            entry = self._load(name)
+            self._databases[name] = entry
+            self._evict()
+            return entry
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(entry["size"] for entry in self._databases.values())
+
+    def clear(self):
+        with self._lock:
+            self._databases.clear()
+
+    def _evict(self):
+        if self.memory_limit is None:
+            return
+        while len(self._databases) > 1 and \
+                sum(entry["size"] for entry in self._databases.values()) > self.memory_limit:
+            name, _ = self._databases.popitem(last=False)
+            print(f"The knowledge database {name} is unloaded (memory limit: {self.memory_limit} bytes).")
+
+    def _meta_mtime(self, name):
+        try:
+            return os.stat(os.path.join(self.root, str(name), "db_meta.json")).st_mtime_ns
+        except OSError:
+            return None
+
+    def _refresh(self, name, entry):
+        # `db_meta.json` is read again only if it has been modified
+        mtime = self._meta_mtime(name)
+        if mtime is None or mtime == entry["meta_mtime"]:
+            return entry
+        db_config = read_db_meta(os.path.join(self.root, str(name)))
+        if db_config.get("version", 0) == entry["config"].get("version", 0):
+            return dict(entry, meta_mtime=mtime)
+        if db_config.get("index_folder", "faiss_index") == entry["config"].get("index_folder", "faiss_index"):
+            print(f"The knowledge database {name} is updated to version {db_config.get('version', 0)}.")
+            return dict(entry, config=db_config, deleted=frozenset(db_config.get("tombstones", [])),
+                        meta_mtime=mtime)
+        print(f"The knowledge database {name} is reloaded (version {db_config.get('version', 0)}).")
+        return self._load(name)
+
+    def _read_index(self, index_path):
+        # return (index, whether its data is memory-mapped)
+        import faiss
+        if self.use_mmap:
+            try:
+                index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            except (AttributeError, RuntimeError):
+                # this version of FAISS doesn't support memory-mapping
+                return faiss.read_index(index_path), False
+            # `IO_FLAG_MMAP` only maps the inverted lists of IVF indexes; the other types are read fully
+            try:
+                faiss.extract_index_ivf(index)
+                return index, True
+            except RuntimeError:
+                return index, False
+        return faiss.read_index(index_path), False
+
+    def _load(self, name):
+        from langchain.vectorstores import FAISS
+        from models import EMBEDDINGS
+
+        db_path = os.path.join(self.root, str(name))
+        if name is None or not os.path.isdir(db_path):
+            raise FileNotFoundError(f"The knowledge database {name} doesn't exist.")
+        # load configuration file
+        meta_mtime = self._meta_mtime(name)
+        db_config = read_db_meta(db_path)
+        embeddings = EMBEDDINGS[db_config["embedding_model"]]
+        index_path = os.path.join(index_folder(db_path, db_config), "index.faiss")
+        docstore_path = os.path.join(index_folder(db_path, db_config), "index.pkl")
+        with span("knowledge.load_database", database=name):
+            index, mapped = self._read_index(index_path)
+            apply_search_parameters(index, db_config.get("index", {}))
+            with open(docstore_path, "rb") as f:
+                docstore, index_to_docstore_id = pickle.load(f)
+            db = FAISS(embeddings.embed_query, index, docstore, index_to_docstore_id)
+        # the size of the files is used as the estimated memory
+        size = os.path.getsize(docstore_path) + (0 if mapped else os.path.getsize(index_path))
+        # "deleted": the ids (in the index) of the deleted chunks, which are skipped by the searches
+        return {"db": db, "config": db_config, "embeddings": embeddings, "size": size,
+                "deleted": frozenset(db_config.get("tombstones", [])), "meta_mtime": meta_mtime}
+
+
+KNOWLEDGE_DATABASES = KnowledgeDatabaseRegistry(
+    memory_limit=int(os.getenv("AUTO_DRAFT_KNOWLEDGE_DB_MEMORY_MB", 4096)) * 1024 * 1024,
+    use_mmap=os.getenv("AUTO_DRAFT_KNOWLEDGE_DB_MMAP", "1") != "0")
+
+
+def _parse_keywords(keywords_dict):
+    # the preliminaries generated by LLM may be a JSON string; a string which is not JSON is one keyword
+    if isinstance(keywords_dict, str):
+        try:
+            keywords_dict = json.loads(keywords_dict)
+        except json.JSONDecodeError:
+            return [keywords_dict] if keywords_dict.strip() else []
+    if isinstance(keywords_dict, str):
+        return [keywords_dict]
+    return [str(kw) for kw in keywords_dict]
+
+
 class Knowledge:
-    def __init__(self, db):
+    def __init__(self, db, embeddings=None, deleted=None):
+        # `embeddings`: the embedding model of `db`, used to embed all keywords in one batch
+        # `deleted`: the ids of the deleted chunks in the index of `db`
         self.db = db
+        self.embeddings = embeddings
+        self.deleted = deleted or frozenset()
         self.contents = []
 
+    def _embed_queries(self, queries):
+        if self.embeddings is not None:
+            vectors = self.embeddings.embed_documents(queries)
+        else:
+            vectors = [self.db.embedding_function(query) for query in queries]
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if getattr(self.db, "_normalize_L2", False):
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    @traced("knowledge.collect_knowledge")
     def collect_knowledge(self, keywords_dict: dict, max_query: int):
         """
         keywords_dict:
             {"machine learning": 5, "language model": 2};
+        All keywords are embedded in one batch and searched by one FAISS search. A chunk found by many keywords is
+        added once (with its best score).
         """
         db = self.db
-        if max_query > 0:
-            for kw in keywords_dict:
-                docs = db.similarity_search_with_score(kw, k=max_query)
-                for i in range(max_query):
-                    content = {"content": docs[i][0].page_content.replace('\n', ' '),
-                               "score": docs[i][1]}  # todo: add more meta information; clean the page_content
-                    self.contents.append(content)
+        queries = _parse_keywords(keywords_dict)
+        if max_query > 0 and queries:
+            import faiss
+            k = min(max_query, db.index.ntotal)
+            # the deleted chunks are skipped by the search itself
+            params = search_parameters(db.index, self.deleted)
+            with span("knowledge.search", queries=len(queries)):
+                scores, indices = db.index.search(self._embed_queries(queries), k, params=params)
+            # the score is a distance (smaller is better) unless the index uses the inner product
+            larger_is_better = db.index.metric_type == faiss.METRIC_INNER_PRODUCT
+            best = {}
+            for row_scores, row_indices in zip(scores, indices):
+                for score, i in zip(row_scores, row_indices):
+                    if i != -1 and (i not in best or (score > best[i] if larger_is_better else score < best[i])):
+                        best[i] = score
+            for i, score in best.items():
+                doc = db.docstore.search(db.index_to_docstore_id[i])
+                content = {"content": doc.page_content.replace('\n', ' '),
+                           "score": float(score)}  # todo: add more meta information; clean the page_content
+                self.contents.append(content)
             # sort contents by score / shuffle
             shuffle(self.contents)
 
+    @traced("knowledge.to_prompts")
     def to_prompts(self, max_tokens=2048):
         if len(self.contents) == 0:
             return ""
@@ -0,0 +1,516 @@
+# This script `knowledge_builder.py` is used to build a knowledge database (see `knowledge.py`) from a folder of
+# documents. The database has the same layout as `knowledge_databases/ml_textbook_test`:
+#       {output_folder}/{name}/faiss_index/index.faiss, index.pkl   (loaded by `KnowledgeDatabaseRegistry`)
+#       {output_folder}/{name}/db_meta.json                         ({"embedding_model": ..., ...})
+#   `iter_documents`:
+#       Read the documents one page (PDF) or one block of lines (.txt, .md, .tex) at a time.
+#   `iter_chunks`:
+#       Split each page/block into chunks of at most `chunk_size` tokens (measured by `tiktoken_len`).
+#   `build_knowledge_database`:
+#       Embed the chunks in batches in a process pool and add them to a FAISS index as they come back. At most
+#       `2 * workers` batches are waiting at the same time, so the memory does not grow with the size of the input
+#       files; only the index itself (vectors and chunk texts) grows with the number of chunks.
+#   `make_index` / `INDEX_TYPES`:
+#       The type of the FAISS index is given by `index_config` and saved as "index" in `db_meta.json`:
+#           {"type": "Flat"}                                                exhaustive search (default)
+#           {"type": "IVF-Flat", "nlist": 1024, "nprobe": 16}               inverted lists
+#           {"type": "HNSW", "M": 32, "efConstruction": 200, "efSearch": 64}  graph
+#           {"type": "IVF-PQ", "nlist": 1024, "m": 16, "nbits": 8, "nprobe": 16}  inverted lists, compressed vectors
+#       Indexes which need training are trained on the first `train_size` vectors.
+#   `append_documents` / `delete_sources` / `compact_knowledge_database`:
+#       Update a database without building it again. New documents are embedded and added to the index; deleted
+#       documents are only marked ("tombstones" in `db_meta.json`) and skipped by the searches until the database is
+#       compacted (in the background, once the tombstones are more than `COMPACT_THRESHOLD` of the chunks; or by
+#       `start_background_compaction`, which `app.py` and `worker.py` start every `COMPACTION_INTERVAL` seconds; set
+#       AUTO_DRAFT_KNOWLEDGE_DB_COMPACTION_INTERVAL to 0 to turn it off). Each update increases "version" in `db_meta.json`, and a new index is saved
+#       in a new folder ("index_folder"), so running processes swap to it without a restart (see
+#       `KnowledgeDatabaseRegistry`). Updates of one database are serialized by a lock file.
+#   `benchmark_index_types`:
+#       Build other index types from the vectors of a Flat database, and report recall@k (against the Flat index),
+#       the query latency and the index size.
+
+import json
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from utils.knowledge import KNOWLEDGE_DATABASES_DIR, apply_search_parameters, index_folder, read_db_meta, \
+    tiktoken_len
+
+TEXT_EXTENSIONS = {".txt", ".md", ".tex"}
+# the number of characters of one block of a text file
+TEXT_BLOCK_SIZE = 20000
+# a database is compacted once more than this fraction of its chunks are deleted
+COMPACT_THRESHOLD = 0.2
+# seconds between two checks of `start_background_compaction`
+COMPACTION_INTERVAL = float(os.getenv("AUTO_DRAFT_KNOWLEDGE_DB_COMPACTION_INTERVAL", 3600))
+
+
+######################################################################################################################
+# Read and split documents
+######################################################################################################################
+def iter_documents(input_folder, skip_sources=()):
+    # yield (text, metadata) of each page of PDF files and each block of text files, file by file
+    for root, _, files in sorted(os.walk(input_folder)):
+        for file_name in sorted(files):
+            path = os.path.join(root, file_name)
+            extension = os.path.splitext(file_name)[1].lower()
+            source = os.path.relpath(path, input_folder)
+            if source in skip_sources:
+                continue
+            if extension == ".pdf":
+                from pypdf import PdfReader
+                try:
+                    reader = PdfReader(path)
+                    for page_number, page in enumerate(reader.pages):
+                        text = page.extract_text() or ""
+                        if text.strip():
+                            yield text, {"source": source, "page": page_number}
+                except Exception as e:
+                    print(f"Failed to read {path}: {e}")
+            elif extension in TEXT_EXTENSIONS:
+                with open(path, "r", encoding="utf-8", errors="replace") as f:
+                    block = []
+                    block_size = 0
+                    block_number = 0
+                    for line in f:
+                        block.append(line)
+                        block_size += len(line)
+                        # a block ends at an empty line once it is long enough
+                        if block_size >= TEXT_BLOCK_SIZE and not line.strip():
+                            yield "".join(block), {"source": source, "block": block_number}
+                            block, block_size, block_number = [], 0, block_number + 1
+                    if "".join(block).strip():
+                        yield "".join(block), {"source": source, "block": block_number}
+
+
+def iter_chunks(documents, chunk_size=500, chunk_overlap=50):
+    from langchain.text_splitter import RecursiveCharacterTextSplitter
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap,
+                                              length_function=tiktoken_len)
+    for text, metadata in documents:
+        for chunk in splitter.split_text(text):
+            yield chunk, metadata
+
+
+def iter_batches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+######################################################################################################################
+# Embed chunks in a process pool
+######################################################################################################################
+_WORKER_EMBEDDINGS = None
+
+
+def _init_worker(embedding_model, threads):
+    # each worker process loads the embedding model once
+    global _WORKER_EMBEDDINGS
+    try:
+        import torch
+        torch.set_num_threads(threads)
+    except ImportError:
+        pass
+    from models import EMBEDDINGS
+    _WORKER_EMBEDDINGS = EMBEDDINGS[embedding_model]
+
+
+def _embed_batch(texts):
+    return np.asarray(_WORKER_EMBEDDINGS.embed_documents(texts), dtype=np.float32)
+
+
+def iter_embedded_batches(batches, embedding_model, workers=4):
+    # yield (batch, vectors) in the order of `batches`; at most `2 * workers` batches are waiting at the same time
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker,
+                             initargs=(embedding_model, threads)) as executor:
+        pending = []
+        for batch in batches:
+            pending.append((batch, executor.submit(_embed_batch, [text for text, _ in batch])))
+            if len(pending) >= 2 * workers:
+                batch, future = pending.pop(0)
+                yield batch, future.result()
+        for batch, future in pending:
+            yield batch, future.result()
+
+
+######################################################################################################################
+# Index types
+######################################################################################################################
+INDEX_TYPES = {
+    "Flat": lambda config: "Flat",
+    "IVF-Flat": lambda config: f"IVF{config.get('nlist', 1024)},Flat",
+    "HNSW": lambda config: f"HNSW{config.get('M', 32)}",
+    "IVF-PQ": lambda config: f"IVF{config.get('nlist', 1024)},PQ{config.get('m', 16)}x{config.get('nbits', 8)}",
+}
+
+
+def make_index(dim, index_config=None):
+    import faiss
+    index_config = index_config or {"type": "Flat"}
+    if index_config["type"] not in INDEX_TYPES:
+        raise ValueError(f"Unknown index type {index_config['type']}; use one of {list(INDEX_TYPES)}.")
+    index = faiss.index_factory(dim, INDEX_TYPES[index_config["type"]](index_config), faiss.METRIC_L2)
+    if "efConstruction" in index_config:
+        faiss.downcast_index(index).hnsw.efConstruction = index_config["efConstruction"]
+    apply_search_parameters(index, index_config)
+    return index
+
+
+def train_size(index_config=None):
+    # the number of vectors used to train the index (k-means needs ~39 vectors per centroid at least)
+    index_config = index_config or {"type": "Flat"}
+    if "train_size" in index_config:
+        return index_config["train_size"]
+    size = 0
+    if index_config["type"].startswith("IVF"):
+        size = 50 * index_config.get("nlist", 1024)
+    if index_config["type"] == "IVF-PQ":
+        size = max(size, 50 * 2 ** index_config.get("nbits", 8))
+    return size
+
+
+class IndexWriter:
+    # add vectors to an index; vectors are buffered until there are enough of them to train the index
+    def __init__(self, index_config=None):
+        self.index_config = index_config or {"type": "Flat"}
+        self.index = None
+        self._buffer = []
+        self._buffered = 0
+
+    def add(self, vectors):
+        if self.index is None:
+            self.index = make_index(vectors.shape[1], self.index_config)
+        if self.index.is_trained:
+            self.index.add(vectors)
+            return
+        self._buffer.append(vectors)
+        self._buffered += len(vectors)
+        if self._buffered >= train_size(self.index_config):
+            self.flush()
+
+    def flush(self):
+        if self.index is None or not self._buffer:
+            return self.index
+        vectors = np.concatenate(self._buffer)
+        self._buffer, self._buffered = [], 0
+        if not self.index.is_trained:
+            try:
+                self.index.train(vectors)
+            except RuntimeError as e:
+                raise RuntimeError(f"{len(vectors)} vectors are not enough to train {self.index_config}; "
+                                   f"use a smaller nlist or the Flat index. Error {e}.")
+        self.index.add(vectors)
+        return self.index
+
+
+######################################################################################################################
+# Build
+######################################################################################################################
+def save_faiss_index(db_path, index, docstore, index_to_docstore_id, folder_name="faiss_index"):
+    # the same files as `FAISS.save_local`
+    import faiss
+    import pickle
+    folder = os.path.join(db_path, folder_name)
+    os.makedirs(folder, exist_ok=True)
+    faiss.write_index(index, os.path.join(folder, "index.faiss"))
+    with open(os.path.join(folder, "index.pkl"), "wb") as f:
+        pickle.dump((docstore, index_to_docstore_id), f)
+
+
+def save_db_meta(db_path, db_config):
+    # replaced atomically, so readers always see a complete file
+    tmp_path = os.path.join(db_path, f"db_meta.json.{os.getpid()}.tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(db_config, f, indent=4)
+    os.replace(tmp_path, os.path.join(db_path, "db_meta.json"))
+
+
+def build_knowledge_database(input_folder, name, output_folder=KNOWLEDGE_DATABASES_DIR,
+                             embedding_model="all-MiniLM-L6-v2", chunk_size=500, chunk_overlap=50,
+                             batch_size=256, workers=4, index_config=None):
+    """
+    Build the knowledge database `{output_folder}/{name}` from the documents in `input_folder`.
+    `index_config` is the type of the index (see `INDEX_TYPES`); defaults to {"type": "Flat"}.
+    Return the path of the database.
+    """
+    from langchain.docstore.document import Document
+    from langchain.docstore.in_memory import InMemoryDocstore
+
+    db_path = os.path.join(output_folder, name)
+    index_config = index_config or {"type": "Flat"}
+    writer = IndexWriter(index_config)
+    documents = {}
+    index_to_docstore_id = {}
+    sources = set()
+
+    chunks = iter_chunks(iter_documents(input_folder), chunk_size, chunk_overlap)
+    for batch, vectors in iter_embedded_batches(iter_batches(chunks, batch_size), embedding_model, workers):
+        # the ids of the index are given in the order the vectors are added, also for buffered vectors
+        writer.add(vectors)
+        for text, metadata in batch:
+            doc_id = str(uuid.uuid4())
+            index_to_docstore_id[len(index_to_docstore_id)] = doc_id
+            documents[doc_id] = Document(page_content=text, metadata=metadata)
+            sources.add(metadata["source"])
+        print(f"{len(index_to_docstore_id)} chunks have been embedded.")
+    index = writer.flush()
+    if index is None:
+        raise RuntimeError(f"No documents are found in {input_folder}.")
+
+    save_faiss_index(db_path, index, InMemoryDocstore(documents), index_to_docstore_id)
+    save_db_meta(db_path, {"embedding_model": embedding_model,
+                           "dim": index.d,
+                           "num_chunks": index.ntotal,
+                           "num_sources": len(sources),
+                           "chunk_size": chunk_size,
+                           "chunk_overlap": chunk_overlap,
+                           "index": index_config,
+                           "version": 1,
+                           "index_folder": "faiss_index",
+                           "tombstones": []})
+    print(f"The knowledge database has been saved to {db_path}.")
+    return db_path
+
+
+######################################################################################################################
+# Update
+######################################################################################################################
+def _db_lock(db_path):
+    from filelock import FileLock
+    return FileLock(os.path.join(db_path, ".lock"))
+
+
+def _read_database(db_path):
+    import faiss
+    import pickle
+    db_config = read_db_meta(db_path)
+    folder = index_folder(db_path, db_config)
+    index = faiss.read_index(os.path.join(folder, "index.faiss"))
+    with open(os.path.join(folder, "index.pkl"), "rb") as f:
+        docstore, index_to_docstore_id = pickle.load(f)
+    return db_config, index, docstore, index_to_docstore_id
+
+
+def _publish(db_path, db_config, index, docstore, index_to_docstore_id, sources):
+    # save the index into a new folder, then switch `db_meta.json` to it; the previous folder is kept for the
+    # processes which are loading it now, and the older ones (including the first "faiss_index") are removed
+    version = db_config.get("version", 0) + 1
+    folder_name = f"faiss_index_v{version}"
+    previous_folder = db_config.get("index_folder", "faiss_index")
+    save_faiss_index(db_path, index, docstore, index_to_docstore_id, folder_name)
+    db_config = dict(db_config, version=version, index_folder=folder_name, dim=index.d,
+                     num_chunks=index.ntotal - len(db_config.get("tombstones", [])), num_sources=len(sources))
+    save_db_meta(db_path, db_config)
+    for name in os.listdir(db_path):
+        if re.fullmatch(r"faiss_index(_v\d+)?", name) and name not in (folder_name, previous_folder):
+            shutil.rmtree(os.path.join(db_path, name), ignore_errors=True)
+    return db_config
+
+
+def _live_sources(docstore, index_to_docstore_id, tombstones):
+    return {docstore.search(doc_id).metadata.get("source") for i, doc_id in index_to_docstore_id.items()
+            if i not in tombstones}
+
+
+def append_documents(input_folder, name, output_folder=KNOWLEDGE_DATABASES_DIR, batch_size=256, workers=4):
+    """
+    Add the documents in `input_folder` which are not in the database yet (by their paths relative to
+    `input_folder`) to `{output_folder}/{name}`. Only the new chunks are embedded. Return the number of new chunks.
+    """
+    from langchain.docstore.document import Document
+
+    db_path = os.path.join(output_folder, name)
+    with _db_lock(db_path):
+        db_config, index, docstore, index_to_docstore_id = _read_database(db_path)
+        tombstones = set(db_config.get("tombstones", []))
+        sources = _live_sources(docstore, index_to_docstore_id, tombstones)
+        num_chunks = index.ntotal
+
+        documents = iter_documents(input_folder, skip_sources=sources)
+        chunks = iter_chunks(documents, db_config.get("chunk_size", 500), db_config.get("chunk_overlap", 50))
+        batches = iter_batches(chunks, batch_size)
+        for batch, vectors in iter_embedded_batches(batches, db_config["embedding_model"], workers):
+            index.add(vectors)
+            new_documents = {}
+            for text, metadata in batch:
+                doc_id = str(uuid.uuid4())
+                index_to_docstore_id[len(index_to_docstore_id)] = doc_id
+                new_documents[doc_id] = Document(page_content=text, metadata=metadata)
+                sources.add(metadata["source"])
+            docstore.add(new_documents)
+            print(f"{index.ntotal - num_chunks} new chunks have been embedded.")
+        if index.ntotal == num_chunks:
+            print("No new documents are found.")
+            return 0
+        _publish(db_path, db_config, index, docstore, index_to_docstore_id, sources)
+    print(f"{index.ntotal - num_chunks} chunks have been added to {db_path}.")
+    return index.ntotal - num_chunks
+
+
+def delete_sources(sources, name, output_folder=KNOWLEDGE_DATABASES_DIR, compact_threshold=COMPACT_THRESHOLD,
+                   background=True):
+    """
+    Mark all chunks of `sources` (paths of documents, as in the metadata of the chunks) as deleted. If more than
+    `compact_threshold` of the chunks are deleted, the database is compacted (in a background thread if
+    `background`). Return the number of deleted chunks.
+    """
+    import pickle
+
+    db_path = os.path.join(output_folder, name)
+    sources = set(sources)
+    with _db_lock(db_path):
+        db_config = read_db_meta(db_path)
+        with open(os.path.join(index_folder(db_path, db_config), "index.pkl"), "rb") as f:
+            docstore, index_to_docstore_id = pickle.load(f)
+        tombstones = set(db_config.get("tombstones", []))
+        deleted = {i for i, doc_id in index_to_docstore_id.items()
+                   if i not in tombstones and docstore.search(doc_id).metadata.get("source") in sources}
+        if not deleted:
+            return 0
+        tombstones |= deleted
+        num_sources = len(_live_sources(docstore, index_to_docstore_id, tombstones))
+        db_config = dict(db_config, version=db_config.get("version", 0) + 1, tombstones=sorted(tombstones),
+                         num_chunks=len(index_to_docstore_id) - len(tombstones), num_sources=num_sources)
+        save_db_meta(db_path, db_config)
+    print(f"{len(deleted)} chunks of {db_path} have been deleted.")
+    if len(tombstones) > compact_threshold * len(index_to_docstore_id):
+        if background:
+            threading.Thread(target=compact_knowledge_database, args=(name, output_folder), daemon=True).start()
+        else:
+            compact_knowledge_database(name, output_folder)
+    return len(deleted)
+
+
+def compact_knowledge_database(name, output_folder=KNOWLEDGE_DATABASES_DIR, batch_size=65536):
+    """
+    Remove the deleted chunks from the index and the docstore of `{output_folder}/{name}`. The vectors are not
+    embedded again: they are read back from the index (which is cloned with its training, then reset).
+    """
+    import faiss
+    from langchain.docstore.in_memory import InMemoryDocstore
+
+    db_path = os.path.join(output_folder, name)
+    with _db_lock(db_path):
+        db_config, index, docstore, index_to_docstore_id = _read_database(db_path)
+        tombstones = set(db_config.get("tombstones", []))
+        if not tombstones:
+            return db_config
+        try:
+            # IVF indexes need a direct map to reconstruct vectors by id
+            faiss.extract_index_ivf(index).make_direct_map()
+        except RuntimeError:
+            pass
+        new_index = faiss.clone_index(index)
+        new_index.reset()
+        documents = {}
+        new_index_to_docstore_id = {}
+        for start in range(0, index.ntotal, batch_size):
+            ids = [i for i in range(start, min(start + batch_size, index.ntotal)) if i not in tombstones]
+            if not ids:
+                continue
+            vectors = index.reconstruct_n(start, min(batch_size, index.ntotal - start))
+            new_index.add(vectors[np.asarray(ids) - start])
+            for i in ids:
+                doc_id = index_to_docstore_id[i]
+                new_index_to_docstore_id[len(new_index_to_docstore_id)] = doc_id
+                documents[doc_id] = docstore.search(doc_id)
+        apply_search_parameters(new_index, db_config.get("index", {}))
+        db_config = dict(db_config, tombstones=[])
+        sources = {document.metadata.get("source") for document in documents.values()}
+        db_config = _publish(db_path, db_config, new_index, InMemoryDocstore(documents), new_index_to_docstore_id,
+                             sources)
+    print(f"{db_path} has been compacted ({len(tombstones)} chunks removed).")
+    return db_config
+
+
+def start_background_compaction(output_folder=KNOWLEDGE_DATABASES_DIR, interval=COMPACTION_INTERVAL,
+                                compact_threshold=COMPACT_THRESHOLD):
+    # compact every database under `output_folder` with too many deleted chunks, every `interval` seconds;
+    # return the daemon thread (None if `interval` is not positive)
+    if interval <= 0:
+        return None
+
+    def _run():
+        while True:
+            names = sorted(os.listdir(output_folder)) if os.path.isdir(output_folder) else []
+            for name in names:
+                db_path = os.path.join(output_folder, name)
+                if not os.path.isfile(os.path.join(db_path, "db_meta.json")):
+                    continue
+                try:
+                    db_config = read_db_meta(db_path)
+                    tombstones = len(db_config.get("tombstones", []))
+                    if tombstones and tombstones > compact_threshold * (db_config.get("num_chunks", 0) + tombstones):
+                        compact_knowledge_database(name, output_folder)
+                except Exception as e:
+                    print(f"Failed to compact {db_path}: {e}")
+            time.sleep(interval)
+
+    thread = threading.Thread(target=_run, daemon=True, name="knowledge_db_compaction")
+    thread.start()
+    return thread
+
+
+######################################################################################################################
+# Benchmark
+######################################################################################################################
+def _search_time(index, queries, k):
+    start = time.perf_counter()
+    _, indices = index.search(queries, k)
+    return indices, (time.perf_counter() - start) / len(queries)
+
+
+def benchmark_index_types(name, index_configs, k=10, num_queries=1000, output_folder=KNOWLEDGE_DATABASES_DIR,
+                          seed=0):
+    """
+    Compare `index_configs` (a list of `index_config`) on the vectors of the Flat database `{output_folder}/{name}`.
+    The queries are `num_queries` vectors of the database (with a little noise). Return a list of
+    {"index", "recall@k", "latency_ms", "size_mb", "build_seconds"}; the first one is the Flat index.
+    """
+    import faiss
+    db_path = os.path.join(output_folder, name)
+    db_config = read_db_meta(db_path)
+    index = faiss.read_index(os.path.join(index_folder(db_path, db_config), "index.faiss"))
+    try:
+        vectors = index.reconstruct_n(0, index.ntotal)
+    except RuntimeError as e:
+        raise RuntimeError(f"The benchmark needs a database with a Flat index. Error {e}.")
+    # the deleted chunks are not searched by the database, so they are not benchmarked either
+    tombstones = db_config.get("tombstones", [])
+    if tombstones:
+        vectors = np.delete(vectors, np.asarray(tombstones, dtype=np.int64), axis=0)
+    rng = np.random.default_rng(seed)
+    queries = vectors[rng.choice(len(vectors), size=min(num_queries, len(vectors)), replace=False)]
+    queries = queries + rng.normal(scale=0.01 * float(np.std(vectors)), size=queries.shape).astype(np.float32)
+
+    flat = make_index(vectors.shape[1])
+    flat.add(vectors)
+    truth, flat_latency = _search_time(flat, queries, k)
+    results = [{"index": {"type": "Flat"}, f"recall@{k}": 1.0, "latency_ms": flat_latency * 1000,
+                "size_mb": len(faiss.serialize_index(flat)) / 2 ** 20, "build_seconds": 0.0}]
+    for index_config in index_configs:
+        start = time.perf_counter()
+        writer = IndexWriter(index_config)
+        for i in range(0, len(vectors), 65536):
+            writer.add(vectors[i: i + 65536])
+        candidate = writer.flush()
+        build_seconds = time.perf_counter() - start
+        found, latency = _search_time(candidate, queries, k)
+        recall = np.mean([len(set(f[f >= 0]) & set(t)) / k for f, t in zip(found, truth)])
+        results.append({"index": index_config, f"recall@{k}": float(recall), "latency_ms": latency * 1000,
+                        "size_mb": len(faiss.serialize_index(candidate)) / 2 ** 20, "build_seconds": build_seconds})
+    return results
@@ -0,0 +1,215 @@
+# This script `paper_store.py` is used to store the papers collected by `References` (see `references.py`).
+#   `PaperStore`:
+#       Each paper is stored once, no matter how many keywords (or sources: Semantic Scholar, arXiv, BibTeX) found it.
+#       A new paper is merged into an existing one if any of the following matches:
+#           1. `paper_id`;
+#           2. one of its external IDs (DOI, arXiv, DBLP, ...; the `external_ids` of the paper);
+#           3. its normalized title;
+#           4. a near-duplicate title: candidates are found by MinHash/LSH on the character 3-grams of the normalized
+#              titles, and confirmed if the Jaccard similarity is at least `NEAR_DUPLICATE_THRESHOLD`.
+#       A match by title (3 or 4) is refused if the two records conflict: both have an external ID of the same type
+#       with different values, or both have a year or a first author and they differ (e.g. "A Survey of Deep
+#       Reinforcement Learning" and "A Survey on Deep Reinforcement Learning" are different papers).
+#       The first stored record is kept (its empty fields are filled by the later ones) and the set of keywords which
+#       found it is saved. Adding or looking up a paper costs O(1) on average.
+#   `normalize_title`:
+#       Lowercase, remove LaTeX braces and punctuation and collapse spaces.
+
+import re
+import zlib
+
+import numpy as np
+
+NEAR_DUPLICATE_THRESHOLD = 0.8
+# 16 bands of 4 rows: titles with Jaccard similarity above ~0.5 become candidates
+NUM_BANDS = 16
+ROWS_PER_BAND = 4
+_PRIME = (1 << 31) - 1
+_rng = np.random.RandomState(1)
+_HASH_A = _rng.randint(1, _PRIME, size=NUM_BANDS * ROWS_PER_BAND).astype(np.uint64)
+_HASH_B = _rng.randint(0, _PRIME, size=NUM_BANDS * ROWS_PER_BAND).astype(np.uint64)
+
+
+def normalize_title(title):
+    title = re.sub(r"[{}\\]", "", title or "").lower()
+    title = re.sub(r"[^a-z0-9]+", " ", title)
+    return " ".join(title.split())
+
+
+def _shingles(normalized_title, n=3):
+    if len(normalized_title) <= n:
+        return {normalized_title}
+    return {normalized_title[i: i + n] for i in range(len(normalized_title) - n + 1)}
+
+
+def _minhash(shingles):
+    values = np.array([zlib.crc32(s.encode("utf-8")) % _PRIME for s in shingles], dtype=np.uint64)
+    # (a * x + b) mod p for every hash function (rows) and every shingle (columns)
+    hashed = (np.outer(_HASH_A, values) + _HASH_B[:, None]) % _PRIME
+    return hashed.min(axis=1)
+
+
+def _jaccard(a, b):
+    return len(a & b) / len(a | b) if a or b else 1.0
+
+
+def _year(paper):
+    year = str(paper.get("year") or "").strip()
+    return year if year.lower() != "none" else ""
+
+
+def _first_author(paper):
+    # the last name of the first author: "Ada Lovelace and ..." or "Lovelace, Ada and ..." -> "lovelace"
+    authors = paper.get("authors") or ""
+    if isinstance(authors, list):
+        authors = " and ".join(str(author) for author in authors)
+    first = re.split(r"\s+and\s+", authors.strip(), maxsplit=1)[0]
+    last_name = first.split(",")[0] if "," in first else (first.split() or [""])[-1]
+    return re.sub(r"[^a-z]", "", re.sub(r"[{}\\]", "", last_name).lower())
+
+
+def _conflicts(a, b):
+    # True if `a` and `b` cannot be the same paper, whatever their titles are
+    ids_a = {k.lower(): str(v).lower() for k, v in (a.get("external_ids") or {}).items() if v}
+    ids_b = {k.lower(): str(v).lower() for k, v in (b.get("external_ids") or {}).items() if v}
+    if any(ids_a[k] != ids_b[k] for k in ids_a.keys() & ids_b.keys()):
+        return True
+    for value in (_year, _first_author):
+        value_a, value_b = value(a), value(b)
+        if value_a and value_b and value_a != value_b:
+            return True
+    return False
+
+
+class PaperStore:
+    def __init__(self):
+        self.papers = {}  # {paper_id: paper}, in insertion order
+        self.keywords = {}  # {paper_id: set of keywords}
+        self.by_keyword = {}  # {keyword: [paper_id]}, in the order found
+        self._aliases = {}  # {paper_id of a merged duplicate: paper_id of the stored paper}
+        self._by_external_id = {}  # {(id type, id): paper_id}
+        self._by_title = {}  # {normalized title: paper_id}
+        self._shingles = {}  # {paper_id: set of 3-grams of the normalized title}
+        self._buckets = {}  # {(band, band hash): [paper_id]}
+
+    def __len__(self):
+        return len(self.papers)
+
+    def __contains__(self, paper_id):
+        return paper_id in self.papers or paper_id in self._aliases
+
+    def get(self, paper_id):
+        return self.papers.get(self._aliases.get(paper_id, paper_id))
+
+    ##################################################################################################################
+    # Lookup
+    ##################################################################################################################
+    @staticmethod
+    def _external_ids(paper):
+        external_ids = paper.get("external_ids") or {}
+        return [(k.lower(), str(v).lower()) for k, v in external_ids.items() if v]
+
+    def _bands(self, shingles):
+        signature = _minhash(shingles)
+        return [(band, signature[band * ROWS_PER_BAND: (band + 1) * ROWS_PER_BAND].tobytes())
+                for band in range(NUM_BANDS)]
+
+    def find(self, paper):
+        """Return the `paper_id` of the stored paper which is the same as `paper`, or None."""
+        paper_id = paper.get("paper_id")
+        if paper_id in self:
+            return self._aliases.get(paper_id, paper_id)
+        for external_id in self._external_ids(paper):
+            if external_id in self._by_external_id:
+                return self._by_external_id[external_id]
+        title = normalize_title(paper.get("title"))
+        if not title:
+            return None
+        if title in self._by_title and not _conflicts(paper, self.papers[self._by_title[title]]):
+            return self._by_title[title]
+        shingles = _shingles(title)
+        for bucket in self._bands(shingles):
+            for candidate in self._buckets.get(bucket, []):
+                if _jaccard(shingles, self._shingles[candidate]) >= NEAR_DUPLICATE_THRESHOLD and \
+                        not _conflicts(paper, self.papers[candidate]):
+                    return candidate
+        return None
+
+    ##################################################################################################################
+    # Merge
+    ##################################################################################################################
+    def add(self, paper, keyword=None):
+        """
+        Add `paper` (found by `keyword`) and return the `paper_id` it is stored as. If the paper is a duplicate, the
+        stored one is kept and its empty fields are filled by `paper`.
+        """
+        stored_id = self.find(paper)
+        if stored_id is None:
+            stored_id = paper["paper_id"]
+            self.papers[stored_id] = paper
+            self.keywords[stored_id] = set()
+            title = normalize_title(paper.get("title"))
+            if title:
+                self._by_title.setdefault(title, stored_id)
+                self._shingles[stored_id] = _shingles(title)
+                for bucket in self._bands(self._shingles[stored_id]):
+                    self._buckets.setdefault(bucket, []).append(stored_id)
+        else:
+            stored = self.papers[stored_id]
+            for key, value in paper.items():
+                if value and not stored.get(key):
+                    stored[key] = value
+            if paper.get("paper_id") and paper["paper_id"] != stored_id:
+                self._aliases[paper["paper_id"]] = stored_id
+        for external_id in self._external_ids(paper):
+            self._by_external_id.setdefault(external_id, stored_id)
+        if keyword is not None:
+            if keyword not in self.by_keyword:
+                self.by_keyword[keyword] = []
+            if keyword not in self.keywords[stored_id]:
+                self.keywords[stored_id].add(keyword)
+                self.by_keyword[keyword].append(stored_id)
+        return stored_id
+
+    def add_many(self, papers, keyword=None):
+        if keyword is not None:
+            self.by_keyword.setdefault(keyword, [])
+        return [self.add(paper, keyword) for paper in papers]
+
+    def get_papers(self, keyword="_all"):
+        if keyword == "_all":
+            return list(self.papers.values())
+        return [self.papers[paper_id] for paper_id in self.by_keyword.get(keyword, [])]
+
+    def counts(self):
+        # {keyword: number of papers found by this keyword}
+        return {keyword: len(paper_ids) for keyword, paper_ids in self.by_keyword.items()}
+
+    ##################################################################################################################
+    # Save and load
+    ##################################################################################################################
+    def to_dict(self):
+        return {"papers": list(self.papers.values()),
+                "by_keyword": self.by_keyword,
+                "aliases": self._aliases}
+
+    @classmethod
+    def from_dict(cls, data):
+        """Restore a store saved by `to_dict`. A dictionary {keyword: [paper]} (the old format) is accepted too."""
+        store = cls()
+        if set(data) == {"papers", "by_keyword", "aliases"} and isinstance(data["by_keyword"], dict):
+            for paper in data["papers"]:
+                store.add(paper)
+            for keyword, paper_ids in data["by_keyword"].items():
+                store.by_keyword.setdefault(keyword, [])
+                for paper_id in paper_ids:
+                    paper = store.get(paper_id)
+                    if paper is not None:
+                        store.add(paper, keyword)
+            for alias, paper_id in data["aliases"].items():
+                if paper_id in store.papers:
+                    store._aliases[alias] = paper_id
+        else:
+            for keyword, papers in data.items():
+                store.add_many(papers, keyword)
+        return store
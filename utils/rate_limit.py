@@ -0,0 +1,142 @@
+# This script `rate_limit.py` is used to limit the requests sent to the LLM API and other web APIs.
+#   `RateLimiter`:
+#       Token buckets of requests per minute (RPM) and tokens per minute (TPM) for each model (or host; either limit
+#       can be omitted). A call waits (queues) in front of the limiter until the buckets have enough capacity,
+#       instead of failing with HTTP 429.
+#       Two backends are supported:
+#           - memory: shared by all threads of this process.
+#           - SQLite (`path` is given): shared by all processes on this host which use the same file.
+#   `RATE_LIMITER`:
+#       The limiter used by `AsyncLLMClient`. It is configured by the environment variables:
+#           AUTO_DRAFT_RATE_LIMIT_BACKEND: "sqlite" (default) or "memory".
+#           AUTO_DRAFT_RATE_LIMITS: JSON, e.g. {"gpt-4": {"rpm": 200, "tpm": 40000}}; it overrides `DEFAULT_LIMITS`.
+#   `SS_RATE_LIMITER`:
+#       The limiter of the Semantic Scholar API (`SS_HOST`). The unauthenticated quota is 100 requests per 5 minutes.
+
+import asyncio
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+from utils.cache import CACHE_DIR
+
+# the limits of each model (matched by the longest prefix of the model name)
+DEFAULT_LIMITS = {
+    "gpt-4": {"rpm": 200, "tpm": 40000},
+    "gpt-3.5-turbo": {"rpm": 3500, "tpm": 90000},
+    "gpt-3.5-turbo-16k": {"rpm": 3500, "tpm": 180000},
+}
+SS_HOST = "api.semanticscholar.org"
+SS_DEFAULT_LIMITS = {SS_HOST: {"rpm": 20}}
+
+
+class RateLimiter:
+    def __init__(self, limits=None, path=None):
+        self.limits = DEFAULT_LIMITS if limits is None else limits
+        self.path = path
+        self._buckets = {}  # memory backend: {name: (level, updated)}
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def _limits_of(self, model):
+        matched = [name for name in self.limits if model.startswith(name)]
+        if not matched:
+            return None
+        return self.limits[max(matched, key=len)]
+
+    ##################################################################################################################
+    # Backends
+    ##################################################################################################################
+    def _connect(self):
+        if self._conn is None:
+            folder = os.path.dirname(self.path)
+            if folder:
+                os.makedirs(folder, exist_ok=True)
+            # autocommit mode; transactions are opened explicitly by `BEGIN IMMEDIATE`
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False, isolation_level=None)
+            self._conn.execute("CREATE TABLE IF NOT EXISTS buckets "
+                               "(name TEXT PRIMARY KEY, level REAL NOT NULL, updated REAL NOT NULL)")
+        return self._conn
+
+    def _load(self, name, capacity, now):
+        if self.path is None:
+            return self._buckets.get(name, (capacity, now))
+        row = self._conn.execute("SELECT level, updated FROM buckets WHERE name = ?", (name,)).fetchone()
+        return (capacity, now) if row is None else row
+
+    def _store(self, name, level, now):
+        if self.path is None:
+            self._buckets[name] = (level, now)
+        else:
+            self._conn.execute("INSERT OR REPLACE INTO buckets (name, level, updated) VALUES (?, ?, ?)",
+                               (name, level, now))
+
+    ##################################################################################################################
+    # Token buckets
+    ##################################################################################################################
+    def try_acquire(self, model, tokens):
+        """
+        Take one request and `tokens` tokens of `model` if both buckets have enough capacity and return 0.
+        Otherwise, take nothing and return how many seconds to wait before trying again.
+        """
+        limits = self._limits_of(model)
+        if limits is None:
+            return 0.0
+        # each bucket: (name, capacity, amount); the capacity is refilled over one minute
+        buckets = [(f"{model}:{kind}", limits[kind], amount)
+                   for kind, amount in (("rpm", 1), ("tpm", tokens)) if kind in limits]
+        with self._lock:
+            if self.path is not None:
+                self._connect().execute("BEGIN IMMEDIATE")
+            try:
+                now = time.time()
+                levels = []
+                wait = 0.0
+                for name, capacity, amount in buckets:
+                    level, updated = self._load(name, capacity, now)
+                    level = min(capacity, level + (now - updated) * capacity / 60)
+                    # a request larger than the whole bucket waits until the bucket is full
+                    amount = min(amount, capacity)
+                    if level < amount:
+                        wait = max(wait, (amount - level) * 60 / capacity)
+                    levels.append((name, level, amount))
+                for name, level, amount in levels:
+                    self._store(name, level if wait > 0 else level - amount, now)
+            finally:
+                if self.path is not None:
+                    self._conn.execute("COMMIT")
+        return wait
+
+    async def acquire(self, model, tokens):
+        loop = asyncio.get_running_loop()
+        while True:
+            if self.path is None:
+                wait = self.try_acquire(model, tokens)
+            else:
+                # the SQLite transaction can wait for other threads and processes; keep it off the event loop
+                wait = await loop.run_in_executor(None, self.try_acquire, model, tokens)
+            if wait <= 0:
+                return
+            # a little jitter so that the waiting calls don't wake up at the same time
+            await asyncio.sleep(wait + random.uniform(0, 0.1))
+
+    def acquire_sync(self, model, tokens):
+        while True:
+            wait = self.try_acquire(model, tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait + random.uniform(0, 0.1))
+
+
+_overrides = json.loads(os.getenv("AUTO_DRAFT_RATE_LIMITS", "{}"))
+_limits = dict(DEFAULT_LIMITS, **{k: v for k, v in _overrides.items() if k != SS_HOST})
+_ss_limits = dict(SS_DEFAULT_LIMITS, **{k: v for k, v in _overrides.items() if k == SS_HOST})
+if os.getenv("AUTO_DRAFT_RATE_LIMIT_BACKEND", "sqlite") == "memory":
+    RATE_LIMITER = RateLimiter(_limits)
+    SS_RATE_LIMITER = RateLimiter(_ss_limits)
+else:
+    RATE_LIMITER = RateLimiter(_limits, path=os.path.join(CACHE_DIR, "rate_limit.sqlite"))
+    SS_RATE_LIMITER = RateLimiter(_ss_limits, path=os.path.join(CACHE_DIR, "rate_limit.sqlite"))
@@ -3,24 +3,45 @@
 #
 # Generate references:
 #   `Reference` class:
+#       0. Papers are stored in a `PaperStore` (see `paper_store.py`): each paper is stored once, and duplicates found
+#          by other keywords or sources are merged into it.
 #       1. Two methods to load papers:
-#           1.1. Read a given string including paper titles separated by `,`
-#           1.2. Read a .bib file
+#           1.1. Read a given string including paper titles (or arXiv IDs / DOIs) separated by `,`
+#                (resolved in a few round trips by `resolve_papers`)
+#           1.2. Read a .bib file (entry by entry, see `bibtex.py`)
 #       2. Given some keywords; use Semantic Scholar API to find papers.
+#          A paper given by its title is searched by `hedged_search`: the sources (`SEARCH_SOURCES`) start one after
+#          another every `HEDGE_DELAY` seconds (or as soon as the previous one finds nothing), and the first one which
+#          finds the paper wins. The paid scraping source (`FALLBACK_SOURCES`) is only used if none of them finds it.
+#          The latency and the win rate of each source are saved in `SEARCH_STATS`.
 #       3. Generate bibtex from the selected papers. --> to_bibtex()
 #       4. Generate prompts from the selected papers: --> to_prompts()
 #               A sample prompt: {"paper_id": "paper summary"}
+#               The papers are packed into `max_tokens` by relevance per token (see `pack_prompts`).
 #       5. Generate json from the selected papers. --> to_json()
-
+#
+# Embeddings (used to rank the papers by the similarity to the target paper):
+#   `EMBEDDING_BACKENDS`: {name: function which embeds a list of papers}. Two backends are available:
+#       "specter": the remote SPECTER API of Semantic Scholar.
+#       "local": `all-MiniLM-L6-v2` (see `models/embeddings.py`) running on CPU; no network access is needed.
+#   The environment variable AUTO_DRAFT_EMBEDDING_BACKEND selects the default backend ("specter"). If "specter" fails,
+#   "local" is used instead. Embeddings of different backends are never compared; the papers are embedded again by
+#   the backend of the target paper if needed (`embeddings_backend` of each paper).
+#   `embed` saves the embeddings of each backend in a memory-mapped store (see `cache.EmbeddingStore`), keyed by the
+#   hash of the title and the abstract; only the missing ones are computed.
+
+import contextvars
+import functools
 import itertools
-import json
+import logging
+import os
 import re
+import threading
 import time
-import uuid
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from typing import Dict, List, Optional, Union
 
 import arxiv
-import bibtexparser
 import numpy as np
 import requests
 import tiktoken
@@ -28,10 +49,45 @@ from numpy.linalg import norm
 from scholarly import ProxyGenerator
 from scholarly import scholarly
 
+from utils.bibtex import iter_bibtex_entries, write_bibtex
+from utils.cache import OFFLINE, SS_CACHE, embedding_store, make_key
+from utils.paper_store import PaperStore
+from utils.rate_limit import SS_HOST, SS_RATE_LIMITER
+from utils.tracing import traced
+
 # used to evaluate embeddings
-URL = "https://model-apis.semanticscholar.org/specter/v1/invoke"
+URL = os.getenv("AUTO_DRAFT_SPECTER_URL", "https://model-apis.semanticscholar.org/specter/v1/invoke")
+# the base URLs of the Semantic Scholar Graph API and the arXiv API (e.g. set them to a local stub server)
+SS_API_URL = os.getenv("AUTO_DRAFT_SS_API_URL", "https://api.semanticscholar.org/graph/v1")
+ARXIV_API_URL = os.getenv("AUTO_DRAFT_ARXIV_API_URL", "http://export.arxiv.org/api/query")
+# maximum number of IDs in one request to the Semantic Scholar batch endpoint
+SS_BATCH_SIZE = 500
+SS_PAPER_FIELDS = ["title", "abstract", "venue", "year", "authors", "tldr", "externalIds"]
 MAX_BATCH_SIZE = 16
 MAX_ATTEMPTS = 20
+# maximum number of concurrent requests to the SPECTER API
+MAX_EMBED_WORKERS = 4
+# maximum number of concurrent abstract lookups in `load_papers_from_bibtex` (the proxies are set up concurrently;
+# the scholarly searches themselves take turns, see `_SCHOLARLY_LOCK`)
+MAX_ABSTRACT_WORKERS = 4
+# seconds to wait for a search source before the next one is started as well
+HEDGE_DELAY = float(os.getenv("AUTO_DRAFT_HEDGE_DELAY", 2.0))
+LOCAL_EMBEDDING_MODEL = "all-MiniLM-L6-v2"
+LOCAL_BATCH_SIZE = 64
+EMBEDDING_BACKEND = os.getenv("AUTO_DRAFT_EMBEDDING_BACKEND", "specter")
+# maximum number of concurrent Semantic Scholar searches in `collect_papers`
+MAX_SEARCH_WORKERS = 8
+
+# one keep-alive connection pool for all Semantic Scholar requests
+SS_SESSION = requests.Session()
+# `scholarly.use_proxy` changes the session of the whole process, so one scholarly search runs at a time
+_SCHOLARLY_LOCK = threading.Lock()
+ARXIV_CLIENT = arxiv.Client()
+ARXIV_CLIENT.query_url_format = ARXIV_API_URL + "?{}"
+
+_ARXIV_ID = re.compile(r"^(?:arxiv:\s*|(?:https?://)?(?:www\.)?arxiv\.org/(?:abs|pdf)/)?(\d{4}\.\d{4,5})(?:v\d+)?"
+                       r"(?:\.pdf)?$", re.IGNORECASE)
+_DOI = re.compile(r"^(?:doi:\s*|(?:https?://)?(?:dx\.)?doi\.org/)?(10\.\d{4,9}/\S+)$", re.IGNORECASE)
 
 # `tokenizer`: used to count how many tokens
 tokenizer_name = tiktoken.encoding_for_model('gpt-4')
@@ -67,39 +123,135 @@ def chunks(lst, chunk_size=MAX_BATCH_SIZE):
         yield lst[i: i + chunk_size]
 
 
-def embed(papers):
+def _specter_request(chunk):
+    # Allow Python requests to convert the data above to JSON
+    response = SS_SESSION.post(URL, json=chunk, timeout=60)
+
+    if response.status_code != 200:
+        raise RuntimeError("Sorry, something went wrong, please try later!")
+    return response.json()["preds"]
+
+
+@traced("references.embed_specter")
+def embed_specter(papers):
+    # the chunks are sent concurrently (at most `MAX_EMBED_WORKERS` at the same time)
     embeddings_by_paper_id: Dict[str, List[float]] = {}
-    for chunk in chunks(papers):
-        # Allow Python requests to convert the data above to JSON
-        response = requests.post(URL, json=chunk)
+    papers = [{"paper_id": paper["paper_id"], "title": paper["title"], "abstract": paper["abstract"]}
+              for paper in papers]
+    with ThreadPoolExecutor(max_workers=MAX_EMBED_WORKERS) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, _specter_request, chunk)
+                   for chunk in chunks(papers)]
+        for future in futures:
+            for paper in future.result():
+                embeddings_by_paper_id[paper["paper_id"]] = paper["embedding"]
 
-        if response.status_code != 200:
-            raise RuntimeError("Sorry, something went wrong, please try later!")
+    return embeddings_by_paper_id
+
+
+@traced("references.embed_local")
+def embed_local(papers):
+    # the model is loaded on the first call
+    from models import EMBEDDINGS
+    model = EMBEDDINGS[LOCAL_EMBEDDING_MODEL]
+    embeddings_by_paper_id: Dict[str, List[float]] = {}
+    for chunk in chunks(papers, LOCAL_BATCH_SIZE):
+        texts = [f"{paper['title']}. {paper['abstract'] or ''}" for paper in chunk]
+        for paper, embedding in zip(chunk, model.embed_documents(texts)):
+            embeddings_by_paper_id[paper["paper_id"]] = embedding
+    return embeddings_by_paper_id
 
-        for paper in response.json()["preds"]:
-            embeddings_by_paper_id[paper["paper_id"]] = paper["embedding"]
 
+EMBEDDING_BACKENDS = {"specter": embed_specter, "local": embed_local}
+# backends which need the network
+REMOTE_BACKENDS = {"specter"}
+
+
+@traced("references.embed")
+def embed(papers, backend=None):
+    backend = EMBEDDING_BACKEND if backend is None else backend
+    store = embedding_store(backend)
+    keys = {paper["paper_id"]: make_key(paper["title"], paper["abstract"]) for paper in papers}
+    cached = store.get_many(keys.values())
+    missing = [paper for paper in papers if keys[paper["paper_id"]] not in cached]
+    if missing and OFFLINE and backend in REMOTE_BACKENDS:
+        raise RuntimeError(f"{len(missing)} embeddings are not in the cache (offline mode).")
+
+    computed = EMBEDDING_BACKENDS[backend](missing) if missing else {}
+    store.put_many({keys[paper_id]: embedding for paper_id, embedding in computed.items()})
+    embeddings_by_paper_id: Dict[str, List[float]] = {}
+    for paper_id, key in keys.items():
+        if key in cached:
+            embeddings_by_paper_id[paper_id] = cached[key].tolist()
+        elif paper_id in computed:
+            embeddings_by_paper_id[paper_id] = computed[paper_id]
     return embeddings_by_paper_id
 
 
-def get_embeddings(paper_title, paper_description):
+def embed_with_fallback(papers, backend=None):
+    # return ({paper_id: embedding}, the backend used)
+    backend = EMBEDDING_BACKEND if backend is None else backend
+    try:
+        return embed(papers, backend), backend
+    except Exception as e:
+        if backend == "local":
+            raise
+        print(f"Failed to embed papers by {backend}: {e}\nUse the local embedding model instead.")
+        return embed(papers, "local"), "local"
+
+
+def get_embeddings(paper_title, paper_description, backend=None):
     output = [{"title": paper_title, "abstract": paper_description, "paper_id": "target_paper"}]
-    emb_vector = embed(output)["target_paper"]
+    embeddings, backend = embed_with_fallback(output, backend)
     target_paper = output[0]
-    target_paper["embeddings"] = emb_vector
+    target_paper["embeddings"] = embeddings["target_paper"]
+    target_paper["embeddings_backend"] = backend
     return target_paper
 
 
-def get_embeddings_vector(paper_title, paper_description):
-    output = [{"title": paper_title, "abstract": paper_description, "paper_id": "target_paper"}]
-    emb_vector = embed(output)["target_paper"]
-    return emb_vector
+def add_embeddings(papers, backend=None):
+    # embed `papers` in one batch and save the embeddings into them
+    embeddings, backend = embed_with_fallback(papers, backend)
+    for paper in papers:
+        paper["embeddings"] = embeddings[paper["paper_id"]]
+        paper["embeddings_backend"] = backend
+    return papers
+
 
+def get_embeddings_vector(paper_title, paper_description, backend=None):
+    return get_embeddings(paper_title, paper_description, backend)["embeddings"]
+
+
+def _candidate_embeddings(papers, backend):
+    # the embeddings of `papers` (a dictionary {paper_id: paper}) by `backend`; only the papers without them are
+    # embedded (in batches). Papers from Semantic Scholar come with SPECTER embeddings.
+    embeddings = {}
+    missing = []
+    for paper_id, paper in papers.items():
+        if paper.get("embeddings") is not None and paper.get("embeddings_backend", "specter") == backend:
+            embeddings[paper_id] = paper["embeddings"]
+        else:
+            missing.append({"paper_id": paper_id, "title": paper["title"], "abstract": paper.get("abstract") or ""})
+    if missing:
+        embeddings.update(embed(missing, backend))
+    return embeddings
 
+
+@traced("references.get_top_k")
 def get_top_k(papers_dict, paper_title, paper_description, k=None):
     # returns the top k papers most similar to the target paper
+    # `papers_dict` is not modified; the returned papers are copies with `cos_sim` and without `embeddings`
+    papers = papers_dict
     target_paper = get_embeddings(paper_title, paper_description)
-    papers = papers_dict  # must include embeddings
+    backend = target_paper["embeddings_backend"]
+    try:
+        embeddings = _candidate_embeddings(papers, backend)
+    except Exception as e:
+        if backend == "local":
+            raise
+        # the target paper is embedded again, so that the same backend is used for all papers
+        print(f"Failed to embed papers by {backend}: {e}\nUse the local embedding model instead.")
+        target_paper = get_embeddings(paper_title, paper_description, "local")
+        embeddings = _candidate_embeddings(papers, "local")
 
     # if k < len(papers_json), return k most relevant papers
     # if k >= len(papers_json) or k is None, return all papers
@@ -107,32 +259,49 @@ def get_top_k(papers_dict, paper_title, paper_description, k=None):
     if k is None:
         k = max_num_papers
     num_papers = min(k, max_num_papers)
+    if num_papers <= 0:
+        return {}
 
-    # evaluate the cosine similarity for each paper
-    target_embedding_vector = target_paper["embeddings"]
-
-    for k in papers:
-        v = papers[k]
-        embedding_vector = v["embeddings"]
-        cos_sim = evaluate_cosine_similarity(embedding_vector, target_embedding_vector)
-        papers[k]["cos_sim"] = cos_sim
+    # evaluate the cosine similarity for all papers by one matrix-vector product;
+    # papers without embeddings (or with embeddings of another size) get 0
+    target_embedding_vector = np.asarray(target_paper["embeddings"], dtype=np.float32)
+    paper_ids = list(papers)
+    matrix = np.zeros((len(paper_ids), len(target_embedding_vector)), dtype=np.float32)
+    for i, paper_id in enumerate(paper_ids):
+        embedding_vector = embeddings.get(paper_id)
+        if embedding_vector is not None and len(embedding_vector) == len(target_embedding_vector):
+            matrix[i] = embedding_vector
+    norms = norm(matrix, axis=1) * norm(target_embedding_vector)
+    cos_sims = np.divide(matrix @ target_embedding_vector, norms, out=np.zeros_like(norms), where=norms > 0)
 
     # return the best k papers
-    sorted_papers = {k: v for k, v in sorted(papers.items(), key=lambda x: x[1]["cos_sim"], reverse=True)[:num_papers]}
-    for key in sorted_papers:
-        sorted_papers[key].pop("embeddings", None)
+    if num_papers < len(paper_ids):
+        top = np.argpartition(-cos_sims, num_papers - 1)[:num_papers]
+    else:
+        top = np.arange(len(paper_ids))
+    top = top[np.argsort(-cos_sims[top], kind="stable")]
+    sorted_papers = {}
+    for i in top:
+        paper = {key: value for key, value in papers[paper_ids[i]].items()
+                 if key not in ("embeddings", "embeddings_backend")}
+        paper["cos_sim"] = float(cos_sims[i])
+        sorted_papers[paper_ids[i]] = paper
     return sorted_papers
 
 
+@traced("references.search_paper_abstract")
 def search_paper_abstract(title):
+    if OFFLINE:
+        return ""
     pg = ProxyGenerator()
     success = pg.FreeProxies()  # pg.ScraperAPI("921b16f94d701308b9d9b4456ddde155")
     if success:
         try:
-            scholarly.use_proxy(pg)
-            # input the title of a paper, return its abstract
-            search_query = scholarly.search_pubs(title)
-            found_paper = next(search_query)
+            with _SCHOLARLY_LOCK:
+                scholarly.use_proxy(pg)
+                # input the title of a paper, return its abstract
+                search_query = scholarly.search_pubs(title)
+                found_paper = next(search_query)
         except:
             return ""
     else:
@@ -147,6 +316,36 @@ def tiktoken_len(text):
     return len(tokens)
 
 
+@functools.lru_cache(maxsize=16384)
+def cached_tiktoken_len(text):
+    # the same abstracts are counted again and again (e.g. by many runs of one worker)
+    return tiktoken_len(text)
+
+
+def pack_prompts(papers, max_tokens):
+    """
+    Choose papers to cite within `max_tokens` and return {paper_id: abstract} (the most relevant first).
+    Each paper costs the tokens of its `paper_id` and its abstract. Papers are taken by relevance (`cos_sim`; 1 if
+    the papers are not ranked) per token as long as they fit, so the total never goes over `max_tokens`.
+    """
+    candidates = []
+    for rank, paper in enumerate(papers):
+        abstract = paper.get("abstract")
+        if abstract is None or not isinstance(abstract, str):
+            abstract = " "
+        tokens = cached_tiktoken_len(paper["paper_id"]) + cached_tiktoken_len(abstract)
+        relevance = max(paper.get("cos_sim", 1.0), 1e-6)
+        candidates.append((relevance / max(tokens, 1), rank, tokens, paper["paper_id"], abstract))
+
+    chosen = []
+    used_tokens = 0
+    for _, rank, tokens, paper_id, abstract in sorted(candidates, key=lambda c: (-c[0], c[1])):
+        if used_tokens + tokens <= max_tokens:
+            chosen.append((rank, paper_id, abstract))
+            used_tokens += tokens
+    return {paper_id: abstract for _, paper_id, abstract in sorted(chosen)}
+
+
 ######################################################################################################################
 # Academic search tools
 ######################################################################################################################
@@ -172,57 +371,66 @@ def externalIds2link(externalIds):
         return ""
 
 
+@traced("references.search_paper_arxiv")
 def search_paper_arxiv(title):
+    if OFFLINE:
+        return {}
     search = arxiv.Search(
         query=title,
         max_results=1,
         sort_by=arxiv.SortCriterion.Relevance
     )
     try:
-        #       (1) paper_id (2) title (3) authors (4) year (5) link (6) abstract (7) journal (8) embeddings
-        result = next(search.results())
-        title = result.title
-        authors = " and ".join([author.name for author in result.authors])
-        year = str(result.updated.now().year)
-        link = result.pdf_url
-        abstract = result.summary
-        journal = f"Arxiv: {result.entry_id}"
-        paper_id = result.authors[0].name.replace(" ", "")[:4] + year + title[:6].replace(" ", "")
-        paper_id = paper_id.lower()
-
-        paper = {"paper_id": paper_id,
-                 "title": title,
-                 "authors": authors,
-                 "year": year,
-                 "link": link,
-                 "abstract": abstract,
-                 "journal": journal}
+        result = next(ARXIV_CLIENT.results(search))
+        paper = _parse_arxiv_result(result)
     except StopIteration:
         paper = {}
     return paper
 
 
+def _parse_arxiv_result(result):
+    #       (1) paper_id (2) title (3) authors (4) year (5) link (6) abstract (7) journal (8) embeddings
+    title = result.title
+    authors = " and ".join([author.name for author in result.authors])
+    year = str(result.updated.now().year)
+    link = result.pdf_url
+    abstract = result.summary
+    journal = f"Arxiv: {result.entry_id}"
+    paper_id = result.authors[0].name.replace(" ", "")[:4] + year + title[:6].replace(" ", "")
+    paper_id = paper_id.lower()
+    external_ids = {"ArXiv": result.get_short_id().rsplit("v", 1)[0]}
+    if result.doi:
+        external_ids["DOI"] = result.doi
+
+    paper = {"paper_id": paper_id,
+             "title": title,
+             "authors": authors,
+             "year": year,
+             "link": link,
+             "abstract": abstract,
+             "journal": journal,
+             "external_ids": external_ids}
+    return paper
+
+
+@traced("references.search_paper_ss")
 def search_paper_ss(title):
     if not title:
         return {}
 
-    fields = ["title", "abstract", "venue", "year", "authors", "tldr", "externalIds"]
-    limit = 1
-    query = title.lower()
-    query = query.replace(" ", "+")
-    url = f'https://api.semanticscholar.org/graph/v1/paper/search?query={query}&limit={limit}&fields={",".join(fields)}'
-    time.sleep(5)
-    headers = {"Accept": "*/*"}
-    response = requests.get(url, headers=headers, timeout=30)
-    results = response.json()
+    # requests are throttled by `SS_RATE_LIMITER` (instead of sleeping 5 seconds) and cached by `ss_search`
+    results = ss_search(title, limit=1, fields=SS_PAPER_FIELDS)
     try:
         total = results['total']
         if total == 0:
             return {}
     except KeyError:
         return {}
-    raw_paper = results['data'][0]
-    if raw_paper['tldr'] is not None:
+    return _parse_ss_paper(results['data'][0])
+
+
+def _parse_ss_paper(raw_paper):
+    if raw_paper.get('tldr') is not None:
         abstract = raw_paper['tldr']['text']
     elif raw_paper['abstract'] is not None:
         abstract = remove_newlines(raw_paper['abstract'])
@@ -248,20 +456,25 @@ def search_paper_ss(title):
         "link": link,
         "authors": authors_str,
         "year": year_str,
-        "journal": journal
+        "journal": journal,
+        "external_ids": raw_paper['externalIds'] or {}
     }
     return paper
 
 
+@traced("references.search_paper_scrape")
 def search_paper_scrape(title):
+    if OFFLINE:
+        return {}
     pg = ProxyGenerator()
     success = pg.ScraperAPI("921b16f94d701308b9d9b4456ddde155")
     if success:
         try:
-            scholarly.use_proxy(pg)
-            # input the title of a paper, return its abstract
-            search_query = scholarly.search_pubs(title)
-            found_paper = next(search_query)
+            with _SCHOLARLY_LOCK:
+                scholarly.use_proxy(pg)
+                # input the title of a paper, return its abstract
+                search_query = scholarly.search_pubs(title)
+                found_paper = next(search_query)
             url = found_paper['pub_url']
 
             result = found_paper['bib']
@@ -287,86 +500,298 @@ def search_paper_scrape(title):
             return {}
 
 
-def search_paper(title, verbose=True):
+class SearchStats:
+    # the latency and the win rate of each search source; shared by all threads
+    def __init__(self):
+        self.searches = 0
+        self.sources = {}
+        self._lock = threading.Lock()
+
+    def _source(self, source):
+        if source not in self.sources:
+            self.sources[source] = {"calls": 0, "found": 0, "wins": 0, "latency": 0.0}
+        return self.sources[source]
+
+    def record(self, source, latency, found):
+        with self._lock:
+            stats = self._source(source)
+            stats["calls"] += 1
+            stats["found"] += int(found)
+            stats["latency"] += latency
+
+    def win(self, source):
+        with self._lock:
+            self.searches += 1
+            if source is not None:
+                self._source(source)["wins"] += 1
+
+    def to_dict(self):
+        with self._lock:
+            return {source: {"calls": stats["calls"], "found": stats["found"], "wins": stats["wins"],
+                             "win_rate": stats["wins"] / self.searches if self.searches else 0.0,
+                             "mean_latency": stats["latency"] / stats["calls"] if stats["calls"] else 0.0}
+                    for source, stats in self.sources.items()}
+
+
+# the sources of `hedged_search`, in the order they are started
+SEARCH_SOURCES = [("semantic_scholar", search_paper_ss), ("arxiv", search_paper_arxiv)]
+# tried one by one only if no source of `SEARCH_SOURCES` finds the paper (ScraperAPI is paid per request; it must
+# not be started just because Semantic Scholar is waiting for its rate limiter)
+FALLBACK_SOURCES = [("scholarly", search_paper_scrape)]
+SEARCH_STATS = SearchStats()
+# the sources which lose are not waited for, so they run in a shared pool instead of a `with` block
+_SOURCE_EXECUTOR = ThreadPoolExecutor(max_workers=4 * len(SEARCH_SOURCES), thread_name_prefix="search_source")
+
+
+def _run_source(source, search, title):
+    start = time.perf_counter()
+    try:
+        paper = search(title)
+    except Exception as e:
+        logging.info(f">>SEARCH>> {source} fails to search {title}: {e}")
+        paper = {}
+    SEARCH_STATS.record(source, time.perf_counter() - start, bool(paper))
+    return paper
+
+
+@traced("references.hedged_search")
+def hedged_search(title, hedge_delay=None):
+    hedge_delay = HEDGE_DELAY if hedge_delay is None else hedge_delay
+    start = time.perf_counter()
+    sources = list(SEARCH_SOURCES)
+    running = {}
+    while sources or running:
+        if sources:
+            source, search = sources.pop(0)
+            running[_SOURCE_EXECUTOR.submit(contextvars.copy_context().run, _run_source, source, search, title)] \
+                = source
+        done, _ = wait(running, timeout=hedge_delay if sources else None, return_when=FIRST_COMPLETED)
+        for future in done:
+            source = running.pop(future)
+            paper = future.result()
+            if paper:
+                # the sources which have not started yet are cancelled; the running ones are ignored
+                for other in running:
+                    other.cancel()
+                SEARCH_STATS.win(source)
+                logging.info(f">>SEARCH>> {source} wins the search of {title} in "
+                             f"{time.perf_counter() - start:.2f} seconds.")
+                return paper
+    for source, search in FALLBACK_SOURCES:
+        paper = _run_source(source, search, title)
+        if paper:
+            SEARCH_STATS.win(source)
+            logging.info(f">>SEARCH>> {source} finds {title} in {time.perf_counter() - start:.2f} seconds.")
+            return paper
+    SEARCH_STATS.win(None)
+    logging.info(f">>SEARCH>> No source finds {title}.")
+    return {}
+
+
+@traced("references.search_paper")
+def search_paper(title, verbose=True, with_embeddings=True, hedge_delay=None):
     if verbose:
         print(f"Searching {title}...")
-    # try Semantic Scholar first
-    paper = search_paper_ss(title)
-    if not paper:
-        paper = search_paper_arxiv(title)
-    if not paper:
-        paper = search_paper_scrape(title)
-    if paper:
-        paper["embeddings"] = get_embeddings_vector(paper_title=paper['title'], paper_description=paper['abstract'])
+    # Semantic Scholar is started first; see `hedged_search`
+    paper = hedged_search(title, hedge_delay)
+    if paper and with_embeddings:
+        add_embeddings([paper])
     if verbose:
         print(f"Search result: {paper}.")
     return paper
 
 
-def load_papers_from_bibtex(bib_file_path):
-    with open(bib_file_path) as bibtex_file:
-        bib_database = bibtexparser.load(bibtex_file)
-    if len(bib_database.entries) == 0:
-        return []
-    else:
-        bib_papers = []
-        for bibitem in bib_database.entries:
-            # Add each paper to `bib_papers`
-            paper_id = bibitem.get("ID")
-            title = bibitem.get("title")
-            if title is None:
-                continue
-            journal = bibitem.get("journal")
-            year = bibitem.get("year")
-            author = bibitem.get("author")
-            abstract = bibitem.get("abstract")
-            if abstract is None:
-                abstract = search_paper_abstract(title)
-            result = {
-                "paper_id": paper_id,
-                "title": title,
-                "link": "",
-                "abstract": abstract,
-                "authors": author,
-                "year": year,
-                "journal": journal
-            }
-            bib_papers.append(result)
-        return bib_papers
-
-
+@traced("references.load_papers_from_bibtex")
+def load_papers_from_bibtex(bib_file_path, lookup_abstracts=True):
+    # The file is parsed entry by entry. Abstracts missing in the file are not searched while parsing; if
+    # `lookup_abstracts` is True, they are searched afterwards in a batch (at most `MAX_ABSTRACT_WORKERS` at the same
+    # time). Otherwise, they are left empty.
+    bib_papers = []
+    for bibitem in iter_bibtex_entries(bib_file_path):
+        # Add each paper to `bib_papers`
+        paper_id = bibitem.get("ID")
+        title = bibitem.get("title")
+        if title is None:
+            continue
+        journal = bibitem.get("journal") or bibitem.get("booktitle")
+        year = bibitem.get("year")
+        author = bibitem.get("author")
+        abstract = bibitem.get("abstract")
+        external_ids = {}
+        if bibitem.get("doi"):
+            external_ids["DOI"] = bibitem["doi"]
+        if bibitem.get("eprint"):
+            external_ids["ArXiv"] = bibitem["eprint"]
+        result = {
+            "paper_id": paper_id,
+            "title": title,
+            "link": bibitem.get("url", ""),
+            "abstract": abstract,
+            "authors": author,
+            "year": year,
+            "journal": journal,
+            "external_ids": external_ids
+        }
+        bib_papers.append(result)
+
+    missing = [paper for paper in bib_papers if paper["abstract"] is None]
+    if missing and lookup_abstracts:
+        with ThreadPoolExecutor(max_workers=MAX_ABSTRACT_WORKERS) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, search_paper_abstract, paper["title"])
+                       for paper in missing]
+            for paper, future in zip(missing, futures):
+                try:
+                    paper["abstract"] = future.result()
+                except Exception as e:
+                    print(f"Failed to find the abstract of {paper['title']}: {e}")
+    for paper in missing:
+        if paper["abstract"] is None:
+            paper["abstract"] = ""
+    return bib_papers
+
+
+@traced("references.load_papers_from_text")
 def load_papers_from_text(text):
     print(text)
 
     # split text by comma
-    titles = [part.strip() for part in text.split(',')]
-    titles = [remove_special_characters(title) for title in titles]
-    papers = []
-    if len(titles) > 0:
-        for title in titles:
-            paper = search_paper(title)
-            if paper:
-                papers.append(paper)
-        return papers
+    references = [part.strip() for part in text.split(',')]
+    references = [reference for reference in references if reference]
+    if len(references) > 0:
+        papers = resolve_papers(references)
+        logging.info(f">>SEARCH>> Statistics of the search sources: {SEARCH_STATS.to_dict()}")
+        # all papers are embedded in one batch
+        return add_embeddings(papers) if papers else []
     else:
         return []
 
 
+def parse_reference_id(reference):
+    # return ("ArXiv", arXiv ID) or ("DOI", DOI) if `reference` is an ID (or its URL); otherwise None (a title)
+    match = _ARXIV_ID.match(reference)
+    if match is not None:
+        return "ArXiv", match.group(1)
+    match = _DOI.match(reference)
+    if match is not None:
+        return "DOI", match.group(1)
+    return None
+
+
+@traced("references.resolve_papers")
+def resolve_papers(references, max_workers=MAX_SEARCH_WORKERS):
+    """
+    Find the papers of `references` (titles, arXiv IDs or DOIs) in a few round trips:
+        1. IDs: Semantic Scholar batch requests (`ss_batch`); the arXiv IDs not found there: one arXiv `id_list` query.
+        2. Titles: `search_paper` of all titles run concurrently (at most `max_workers` at the same time).
+    Return the found papers (without embeddings) in the order of `references`.
+    """
+    parsed = [parse_reference_id(reference) for reference in references]
+    ss_ids = [f"{'ARXIV' if kind == 'ArXiv' else 'DOI'}:{value}" for kind, value in filter(None, parsed)]
+    raw_papers = ss_batch(ss_ids)
+    arxiv_ids = [value for kind, value in filter(None, parsed)
+                 if kind == "ArXiv" and f"ARXIV:{value}" not in raw_papers]
+    arxiv_papers = arxiv_batch(arxiv_ids)
+
+    titles = [remove_special_characters(reference) for reference, item in zip(references, parsed) if item is None]
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(contextvars.copy_context().run, search_paper, title, False, False)
+                   for title in titles]
+        title_papers = iter([future.result() for future in futures])
+
+    papers = []
+    for reference, item in zip(references, parsed):
+        if item is None:
+            paper = next(title_papers)
+        else:
+            kind, value = item
+            raw_paper = raw_papers.get(f"{'ARXIV' if kind == 'ArXiv' else 'DOI'}:{value}")
+            if raw_paper is not None:
+                paper = _parse_ss_paper(raw_paper)
+            else:
+                paper = arxiv_papers.get(value, {}) if kind == "ArXiv" else {}
+        if paper:
+            papers.append(paper)
+        else:
+            print(f"Failed to find {reference}.")
+    return papers
+
+
 ######################################################################################################################
 # Semantic Scholar (SS) API
 ######################################################################################################################
+@traced("references.ss_search")
 def ss_search(keywords, limit=20, fields=None):
-    # space between the  query to be removed and replaced with +
+    # Successful responses are cached by the normalized query, limit and fields (see `SS_CACHE`).
+    # In the offline mode, a query which is not in the cache returns no results.
     if fields is None:
         fields = ["title", "abstract", "venue", "year", "authors", "tldr", "embedding", "externalIds"]
-    keywords = keywords.lower()
+    keywords = " ".join(keywords.lower().split())
+    key = make_key("paper/search", keywords, limit, sorted(fields))
+    results = SS_CACHE.get(key)
+    if results is not None:
+        return results
+    if OFFLINE:
+        return {}
+
+    # space between the  query to be removed and replaced with +
     keywords = keywords.replace(" ", "+")
-    url = f'https://api.semanticscholar.org/graph/v1/paper/search?query={keywords}&limit={limit}&fields={",".join(fields)}'
+    url = f'{SS_API_URL}/paper/search?query={keywords}&limit={limit}&fields={",".join(fields)}'
     # headers = {"Accept": "*/*", "x-api-key": constants.S2_KEY}
     headers = {"Accept": "*/*"}
 
-    response = requests.get(url, headers=headers, timeout=30)
-    return response.json()
+    SS_RATE_LIMITER.acquire_sync(SS_HOST, 0)
+    response = SS_SESSION.get(url, headers=headers, timeout=30)
+    results = response.json()
+    if response.status_code == 200:
+        SS_CACHE.set(key, results)
+    return results
+
+
+@traced("references.ss_batch")
+def ss_batch(ids, fields=None):
+    # `ids`: e.g. ["DOI:10.18653/v1/N18-3011", "ARXIV:2106.15928"]; return {id: raw paper} of the found papers.
+    # Each found paper is cached (see `SS_CACHE`); the others are requested by `SS_BATCH_SIZE` IDs per request.
+    if fields is None:
+        fields = SS_PAPER_FIELDS
+    found = {}
+    missing = []
+    for paper_id in dict.fromkeys(ids):
+        raw_paper = SS_CACHE.get(make_key("paper/batch", paper_id, sorted(fields)))
+        if raw_paper is not None:
+            found[paper_id] = raw_paper
+        else:
+            missing.append(paper_id)
+    if OFFLINE:
+        return found
+
+    for chunk in chunks(missing, SS_BATCH_SIZE):
+        SS_RATE_LIMITER.acquire_sync(SS_HOST, 0)
+        response = SS_SESSION.post(f"{SS_API_URL}/paper/batch", params={"fields": ",".join(fields)},
+                                   json={"ids": chunk}, headers={"Accept": "*/*"}, timeout=60)
+        if response.status_code != 200:
+            print(f"Semantic Scholar batch request fails ({response.status_code}): {response.text[:200]}")
+            continue
+        # the response is a list in the order of `ids`; null if not found
+        for paper_id, raw_paper in zip(chunk, response.json()):
+            if raw_paper is not None:
+                found[paper_id] = raw_paper
+                SS_CACHE.set(make_key("paper/batch", paper_id, sorted(fields)), raw_paper)
+    return found
+
+
+@traced("references.arxiv_batch")
+def arxiv_batch(arxiv_ids):
+    # return {arXiv ID (without version): paper} of the found papers, by one `id_list` query
+    if not arxiv_ids or OFFLINE:
+        return {}
+    search = arxiv.Search(id_list=list(arxiv_ids), max_results=len(arxiv_ids))
+    found = {}
+    try:
+        for result in ARXIV_CLIENT.results(search):
+            found[result.get_short_id().rsplit("v", 1)[0]] = _parse_arxiv_result(result)
+    except Exception as e:
+        print(f"arXiv id_list query fails: {e}")
+    return found
 
 
 def _collect_papers_ss(keyword, counts=3, tldr=False):
@@ -407,8 +832,9 @@ def _collect_papers_ss(keyword, counts=3, tldr=False):
             year_str = str(raw_paper['year'])
             title = raw_paper['title']
 
-            # some journal may contain &; replace it. e.g. journal={IEEE Power & Energy Society General Meeting}
-            journal = raw_paper['venue'].replace("&", "\\&")
+            # LaTeX special characters (e.g. journal={IEEE Power & Energy Society General Meeting}) are escaped
+            # when the bibtex file is written
+            journal = raw_paper['venue']
             if not journal:
                 journal = "arXiv preprint"
 
@@ -434,7 +860,8 @@ def _collect_papers_ss(keyword, counts=3, tldr=False):
                 "authors": authors_str,
                 "year": year_str,
                 "journal": journal,
-                "embeddings": embeddings
+                "embeddings": embeddings,
+                "external_ids": raw_paper['externalIds'] or {}
             }
             papers_ss.append(result)
         return papers_ss
@@ -461,36 +888,52 @@ class References:
                  load_bibtex: Optional[str] = None,
                  description: str = ""
                  ):
-        self.papers = {}
+        self.papers = PaperStore()
         if load_bibtex is not None:
-            self.papers["load_from_bibtex"] = load_papers_from_bibtex(load_bibtex)
+            self.papers.add_many(load_papers_from_bibtex(load_bibtex), "load_from_bibtex")
         if load_papers is not None:
-            self.papers["load_from_text"] = load_papers_from_text(load_papers)
+            self.papers.add_many(load_papers_from_text(load_papers), "load_from_text")
 
         self.title = title
         self.description = description
 
+    def dump_papers(self):
+        """Return all collected papers as a JSON-serializable object, which can be restored by `load_papers`."""
+        return self.papers.to_dict()
+
+    def load_papers(self, papers) -> None:
+        self.papers = PaperStore.from_dict(papers)
+
     def generate_keywords_dict(self) -> Dict[str, int]:
-        keywords_dict = {}
-        for k in self.papers:
-            keywords_dict[k] = len(self.papers[k])
-        return keywords_dict
+        # {keyword: number of distinct papers found by this keyword}
+        return self.papers.counts()
 
-    def collect_papers(self, keywords_dict: Dict[str, int], tldr: bool = False) -> None:
+    @traced("references.collect_papers")
+    def collect_papers(self, keywords_dict: Dict[str, int], tldr: bool = False,
+                       max_workers: int = MAX_SEARCH_WORKERS) -> None:
         """
         Collect as many papers as possible
 
         keywords_dict:
             {"machine learning": 5, "language model": 2};
             the first is the keyword, the second is how many references are needed.
+
+        The searches of all keywords (and their pairs) run concurrently with at most `max_workers` threads, and all
+        threads share the Semantic Scholar rate limiter. The results are merged into the paper store in the order of
+        the keywords.
         """
         keywords = list(keywords_dict)
         comb_keywords = list(itertools.combinations(keywords, 2))
         for comb_keyword in comb_keywords:
             keywords.append(" ".join(comb_keyword))
-        for key in keywords:
-            self.papers[key] = _collect_papers_ss(key, 10, tldr)
-
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(contextvars.copy_context().run, _collect_papers_ss, key, 10, tldr)
+                       for key in keywords]
+            results = [future.result() for future in futures]
+        for key, papers in zip(keywords, results):
+            self.papers.add_many(papers, key)
+
+    @traced("references.to_bibtex")
     def to_bibtex(self, path_to_bibtex: str = "ref.bib") -> List[str]:
         """
         Turn the saved paper list into bibtex file "ref.bib". Return a list of all `paper_id`.
@@ -499,55 +942,21 @@ class References:
 
         num_papers = len(papers)
         print(f"{num_papers} papers will be added to `ref.bib`.")
-        # clear the bibtex file
-        with open(path_to_bibtex, "w", encoding="utf-8") as file:
-            file.write("")
-
-        bibtex_entries = []
-        paper_ids = []
-        seen = set()
-        for paper in papers:
-            if paper["paper_id"] in seen:
-                continue
-            else:
-                seen.add(paper["paper_id"])
-            bibtex_entry = f"""@article{{{paper["paper_id"]},
-          title = {{{paper["title"]}}},
-          author = {{{paper["authors"]}}}, 
-          journal={{{paper["journal"]}}}, 
-          year = {{{paper["year"]}}}, 
-          url = {{{paper["link"]}}}
-        }}"""
-            bibtex_entries.append(bibtex_entry)
-            paper_ids.append(paper["paper_id"])
-            # Save the generated BibTeX entries to a file
-            with open(path_to_bibtex, "a", encoding="utf-8") as file:
-                file.write(bibtex_entry)
-                file.write("\n\n")
-                # print(f'{paper["paper_id"]} has been added to `ref.bib`.')
-        return paper_ids
+        return write_bibtex(papers, path_to_bibtex)
 
     def _get_papers(self, keyword="_all"):
-        if keyword == "_all":
-            papers = []
-            for k, v in self.papers.items():
-                papers = papers + v
-        else:
-            papers = self.papers["keyword"]
-        return papers
+        return self.papers.get_papers(keyword)
 
+    @traced("references.to_prompts")
     def to_prompts(self, keyword: str = "_all", max_tokens: int = 2048):
         # `prompts`:
         #   {"paper1_bibtex_id": "paper_1_abstract", "paper2_bibtex_id": "paper2_abstract"}
         #   this will be used to instruct GPT model to cite the correct bibtex entry.
 
-        # two steps:
+        # two steps (in memory, nothing is written to the disk):
         #   1. Sort everything from most relevant to less relevant
-        #   2. Add paper to prompts until max_tokens
-        json_path = str(uuid.uuid1()) + ".json"
-        papers_json = self.to_json()
-        with open(json_path, "w") as f:
-            json.dump(papers_json, f)
+        #   2. Pack papers into prompts by relevance per token, within max_tokens
+        papers_json = self.to_json(keyword)
         try:
             # Use external API to obtain the most relevant papers
             title = self.title
@@ -558,18 +967,7 @@ class References:
             print(f"Error occurs during calling external API: {e}\n")
             print("Use default method instead!")
             result = self._get_papers(keyword)
-        prompts = {}
-        tokens = 0
-        for paper in result:
-            abstract = paper.get("abstract")
-            if abstract is not None and isinstance(abstract, str):
-                prompts[paper["paper_id"]] = paper["abstract"]
-                tokens += tiktoken_len(paper["abstract"])
-            else:
-                prompts[paper["paper_id"]] = " "
-            if tokens >= max_tokens:
-                break
-        return prompts
+        return pack_prompts(result, max_tokens)
 
     def to_json(self, keyword: str = "_all"):
         papers = self._get_papers(keyword)
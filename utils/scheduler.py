@@ -0,0 +1,62 @@
+# This script `scheduler.py` is used to run a group of jobs as a dependency graph.
+#   `run_dependency_graph`:
+#       `jobs` is a dictionary {name: callable}; each callable takes no arguments.
+#       `dependencies` is a dictionary {name: [names of the jobs which must be finished first]}.
+#       A job is submitted to a thread pool as soon as all of its dependencies are finished, so independent jobs
+#       run concurrently (at most `max_workers` at the same time). Return a dictionary {name: result}.
+#       If any job raises an exception, the jobs which have not started yet are cancelled and the exception is
+#       raised again.
+#       If `timings` (a dictionary) is given, the wall time (in seconds) of each finished job is saved into it.
+#       Each job runs in a copy of the caller's context, so the current tracer (see `tracing.py`) is kept.
+
+import contextvars
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+
+def _timed(job, name, timings):
+    def _run():
+        start = time.perf_counter()
+        try:
+            return job()
+        finally:
+            timings[name] = time.perf_counter() - start
+    return _run
+
+
+def run_dependency_graph(jobs, dependencies=None, max_workers=4, timings=None):
+    if dependencies is None:
+        dependencies = {}
+    if timings is not None:
+        jobs = {name: _timed(job, name, timings) for name, job in jobs.items()}
+    # dependencies on jobs that are not in `jobs` are ignored
+    pending = {name: set(dependencies.get(name, [])) & set(jobs) for name in jobs}
+    results = {}
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        running = {}
+
+        def submit_ready_jobs():
+            for name in list(pending):
+                if not pending[name]:
+                    del pending[name]
+                    running[executor.submit(contextvars.copy_context().run, jobs[name])] = name
+
+        submit_ready_jobs()
+        if pending and not running:
+            raise ValueError(f"Circular dependencies are found among {sorted(pending)}.")
+        while running:
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    results[name] = future.result()
+                except Exception:
+                    for other in running:
+                        other.cancel()
+                    raise
+                for deps in pending.values():
+                    deps.discard(name)
+            submit_ready_jobs()
+            if pending and not running:
+                raise ValueError(f"Circular dependencies are found among {sorted(pending)}.")
+    return results
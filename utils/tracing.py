@@ -0,0 +1,97 @@
+# This script `tracing.py` is used to trace the stages of one generation run.
+#   `Tracer`:
+#       Collects the spans of one run as Chrome trace events. `save` writes them into a JSON file which can be opened
+#       by chrome://tracing or https://ui.perfetto.dev. If `opentelemetry` is installed and `use_otel` is True,
+#       every span is also reported as an OpenTelemetry span.
+#   `activate(tracer)`:
+#       A context manager which makes `tracer` the current tracer (of this thread or task; use
+#       `contextvars.copy_context` to carry it into thread pools).
+#   `span(name, **attributes)` / `traced(name)`:
+#       Trace a block of code / a function. When no tracer is active they do nothing but one context variable lookup.
+#   TRACE_ENABLED:
+#       Set the environment variable AUTO_DRAFT_TRACE to 1 to trace every run by default.
+
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+TRACE_ENABLED = os.getenv("AUTO_DRAFT_TRACE", "0") == "1"
+
+_CURRENT_TRACER = contextvars.ContextVar("current_tracer", default=None)
+_NO_SPAN = contextlib.nullcontext()
+
+
+class Tracer:
+    def __init__(self, name="auto-draft", use_otel=True):
+        self.name = name
+        self.events = []
+        self.use_otel = use_otel and otel_trace is not None
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        otel_span = contextlib.nullcontext()
+        if self.use_otel:
+            otel_span = otel_trace.get_tracer(self.name).start_as_current_span(name, attributes=attributes)
+        start = time.perf_counter()
+        try:
+            with otel_span:
+                yield
+        finally:
+            end = time.perf_counter()
+            event = {"name": name, "cat": name.split(".")[0], "ph": "X",
+                     "ts": (start - self._start) * 1e6, "dur": (end - start) * 1e6,
+                     "pid": os.getpid(), "tid": threading.get_ident(), "args": attributes}
+            with self._lock:
+                self.events.append(event)
+
+    def to_dict(self):
+        with self._lock:
+            return {"traceEvents": list(self.events), "displayTimeUnit": "ms"}
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f)
+
+
+def current_tracer():
+    return _CURRENT_TRACER.get()
+
+
+@contextlib.contextmanager
+def activate(tracer):
+    token = _CURRENT_TRACER.set(tracer)
+    try:
+        yield tracer
+    finally:
+        _CURRENT_TRACER.reset(token)
+
+
+def span(name, **attributes):
+    tracer = _CURRENT_TRACER.get()
+    if tracer is None:
+        return _NO_SPAN
+    return tracer.span(name, **attributes)
+
+
+def traced(name):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            tracer = _CURRENT_TRACER.get()
+            if tracer is None:
+                return func(*args, **kwargs)
+            with tracer.span(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
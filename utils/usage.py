@@ -0,0 +1,106 @@
+# This script `usage.py` is used to meter the usage of one generation run.
+#   `UsageMeter`:
+#       Records, for each generating target (a stage or a section), the prompt/completion tokens, the request latency,
+#       the number of retries, the time to first token and the wall time. It can be updated from many threads.
+#       `save` writes everything into a JSON file (e.g. `usage.json` next to `generation.log`).
+#   `TokenBudget`:
+#       A token budget shared by many runs (e.g. a batch of drafts). Each `UsageMeter` with this budget adds its usage
+#       to it, and `UsageMeter.check_budget` raises `RuntimeError` once the budget is used up.
+
+import json
+import logging
+import threading
+
+
+class TokenBudget:
+    def __init__(self, max_tokens):
+        self.max_tokens = max_tokens
+        self.used_tokens = 0
+        self._lock = threading.Lock()
+
+    def consume(self, tokens):
+        with self._lock:
+            self.used_tokens += tokens
+
+    def exceeded(self):
+        with self._lock:
+            return self.max_tokens is not None and self.used_tokens >= self.max_tokens
+
+
+class UsageMeter:
+    def __init__(self, print_out=True, budget=None):
+        self.print_out = print_out
+        self.budget = budget
+        self.targets = {}
+        self.total = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0, "cached_tokens": 0,
+                      "requests": 0, "cached_requests": 0, "retries": 0}
+        self._lock = threading.Lock()
+
+    def _target(self, generating_target):
+        if generating_target not in self.targets:
+            self.targets[generating_target] = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0,
+                                               "cached_tokens": 0, "requests": 0, "cached_requests": 0,
+                                               "retries": 0, "latency": 0.0, "time_to_first_token": None,
+                                               "wall_time": None}
+        return self.targets[generating_target]
+
+    def log_usage(self, usage, generating_target):
+        """
+        Record the `usage` returned by `GPTModel` for `generating_target`, and print/log a message.
+        """
+        prompts_tokens = usage['prompt_tokens']
+        completion_tokens = usage['completion_tokens']
+        total_tokens = usage['total_tokens']
+        cached = usage.get("cached", False)
+
+        with self._lock:
+            target = self._target(generating_target)
+            target["requests"] += 1
+            self.total["requests"] += 1
+            if cached:
+                target["cached_requests"] += 1
+                target["cached_tokens"] += total_tokens
+                self.total["cached_requests"] += 1
+                self.total["cached_tokens"] += total_tokens
+            else:
+                for key, value in (("prompt_tokens", prompts_tokens), ("completion_tokens", completion_tokens),
+                                   ("total_tokens", total_tokens), ("retries", usage.get("retries", 0))):
+                    target[key] += value
+                    self.total[key] += value
+            target["latency"] += usage.get("latency", 0.0)
+            if usage.get("time_to_first_token") is not None and target["time_to_first_token"] is None:
+                target["time_to_first_token"] = usage["time_to_first_token"]
+            used_in_total = self.total["total_tokens"]
+        if self.budget is not None and not cached:
+            self.budget.consume(total_tokens)
+
+        if cached:
+            message = f">>USAGE>> For generating {generating_target}, the response is loaded from the cache " \
+                      f"({total_tokens} tokens saved)."
+        else:
+            message = f">>USAGE>> For generating {generating_target}, {total_tokens} tokens have been used " \
+                      f"({prompts_tokens} for prompts; {completion_tokens} for completion). " \
+                      f"{used_in_total} tokens have been used in total."
+        if self.print_out:
+            print(message)
+        logging.info(message)
+
+    def check_budget(self):
+        if self.budget is not None and self.budget.exceeded():
+            raise RuntimeError(f"The token budget ({self.budget.max_tokens} tokens) has been used up.")
+
+    def log_time(self, generating_target, seconds):
+        with self._lock:
+            self._target(generating_target)["wall_time"] = seconds
+        message = f">>TIME>> {generating_target} takes {seconds:.2f} seconds."
+        if self.print_out:
+            print(message)
+        logging.info(message)
+
+    def to_dict(self):
+        with self._lock:
+            return {"total": dict(self.total), "targets": {k: dict(v) for k, v in self.targets.items()}}
+
+    def save(self, path):
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.to_dict(), f, indent=4)
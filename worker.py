@@ -4,6 +4,7 @@ This script is only used for service-side host.
 import boto3
 import os, time
 from wrapper import generator_wrapper
+from utils.knowledge_builder import start_background_compaction
 from sqlalchemy import create_engine, Table, MetaData, update, select
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy import inspect
@@ -147,8 +148,16 @@ def pipeline(message_count=0, query_interval=10):
         print(f"Success in the initialization. Message deleted.")
 
         print("Running ...")
+        tokens_count = {}
+
+        def log_progress(section, token):
+            # print the progress of each section every 500 streamed tokens
+            tokens_count[section] = tokens_count.get(section, 0) + 1
+            if tokens_count[section] % 500 == 1:
+                print(f"Generating {section}: {tokens_count[section]} tokens received.")
+
         # try:
-        zip_path = generator_wrapper(config_local_path)
+        zip_path = generator_wrapper(config_local_path, progress_callback=log_progress)
         # Upload the generated file to S3
         upload_to = os.path.join(config_s3_dir, zip_path).replace("\\", "/")
 
@@ -170,4 +179,6 @@ def initialize_everything():
 
 
 if __name__ == "__main__":
+    # compact the knowledge databases with many deleted chunks while this worker is running
+    start_background_compaction()
     pipeline()
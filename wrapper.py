@@ -14,6 +14,10 @@ todo:
 """
 from auto_generators import generate_draft
 from utils.file_operations import make_archive
+from utils.tracing import Tracer, activate, span, TRACE_ENABLED
+from utils.usage import TokenBudget, UsageMeter
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import os
 import yaml
 import uuid
 
@@ -22,33 +26,70 @@ def remove_special_characters(s):
     return ''.join(c for c in s if c.isalnum() or c.isspace() or c == ',')
 
 
-def generator_wrapper(config):
+def generator_wrapper(config, progress_callback=None, meter=None):
     if not isinstance(config, dict):
         with open(config, "r") as file:
             config = yaml.safe_load(file)
     title = config["paper"]["title"]
     generator = config["generator"]
+    tracer = Tracer() if config["output"].get("trace", TRACE_ENABLED) else None
     if generator == "auto_draft":
-        folder = generate_draft(title, config["paper"]["description"],
-                                tldr=config["references"]["tldr"],
-                                max_kw_refs=config["references"]["max_kw_refs"],
-                                refs=config["references"]["refs"],
-                                max_tokens_ref=config["references"]["max_tokens_ref"],
-                                knowledge_database=config["domain_knowledge"]["knowledge_database"],
-                                max_tokens_kd=config["domain_knowledge"]["max_tokens_kd"],
-                                query_counts=config["domain_knowledge"]["query_counts"],
-                                sections=config["output"]["selected_sections"],
-                                model=config["output"]["model"],
-                                template=config["output"]["template"],
-                                prompts_mode=config["output"]["prompts_mode"],
-                                )
+        with activate(tracer), span("generator_wrapper", generator=generator):
+            folder = generate_draft(title, config["paper"]["description"],
+                                    tldr=config["references"]["tldr"],
+                                    max_kw_refs=config["references"]["max_kw_refs"],
+                                    refs=config["references"]["refs"],
+                                    max_tokens_ref=config["references"]["max_tokens_ref"],
+                                    knowledge_database=config["domain_knowledge"]["knowledge_database"],
+                                    max_tokens_kd=config["domain_knowledge"]["max_tokens_kd"],
+                                    query_counts=config["domain_knowledge"]["query_counts"],
+                                    sections=config["output"]["selected_sections"],
+                                    model=config["output"]["model"],
+                                    template=config["output"]["template"],
+                                    prompts_mode=config["output"]["prompts_mode"],
+                                    max_workers=config["output"].get("max_workers", 4),
+                                    stream=config["output"].get("stream") or progress_callback is not None,
+                                    progress_callback=progress_callback,
+                                    trace=tracer is not None,
+                                    resume_from=config["output"].get("resume_from"),
+                                    meter=meter,
+                                    )
     else:
         raise NotImplementedError(f"The generator {generator} has not been supported yet.")
     # todo: post processing: algorithms (in methodology), translate to Chinese, compile PDF ...
+    if tracer is not None:
+        tracer.save(os.path.join(folder, "trace.json"))
     filename = remove_special_characters(title).replace(" ", "_") + uuid.uuid1().hex + ".zip"
     return make_archive(folder, filename)
 
 
+def batch_generator_wrapper(configs, max_jobs=2, token_budget=None):
+    """
+    Generate many drafts at once. `configs` is a list of configurations (dictionaries or paths to YAML files).
+
+    All jobs run in this process, so they share the LLM client (one connection pool), the LLM cache and the loaded
+    knowledge databases. At most `max_jobs` jobs run at the same time. If `token_budget` is given, all jobs together
+    use at most about this many tokens; once it is used up, the unfinished jobs fail.
+
+    Each job runs up to `output.max_workers` stages or sections at the same time, so up to `max_jobs` times
+    `max_workers` LLM requests (8 with the defaults) can be in flight. Nothing else caps this total; the requests
+    per minute and tokens per minute are still limited by `RATE_LIMITER` (see `utils/rate_limit.py`). Lower
+    `max_jobs` or `max_workers` to send fewer requests at once.
+
+    Yield (index, output, error) as each job finishes, where `index` is the position of the configuration in
+    `configs`, `output` is the path of the .zip file (None if failed) and `error` is the raised exception (or None).
+    """
+    budget = TokenBudget(token_budget)
+    with ThreadPoolExecutor(max_workers=max_jobs) as executor:
+        futures = {executor.submit(generator_wrapper, config, meter=UsageMeter(budget=budget)): idx
+                   for idx, config in enumerate(configs)}
+        for future in as_completed(futures):
+            try:
+                yield futures[future], future.result(), None
+            except Exception as e:
+                yield futures[future], None, e
+
+
 if __name__ == "__main__":
     pass
     # with open("configurations/default.yaml", 'r') as file: